@@ -1,45 +1,109 @@
 #!/usr/bin/env python3
 
 # Remote library imports
-from flask import request, jsonify
-from flask_bcrypt import Bcrypt
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
-import requests
-from requests.auth import HTTPBasicAuth
+from flask import request, jsonify, send_file, stream_with_context
+from flask_jwt_extended import create_access_token, create_refresh_token, get_jwt, jwt_required, get_jwt_identity
 import datetime
-import base64
+import hmac
+import re
+from urllib.parse import urlencode
+from sqlalchemy import func, insert, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
 
 # Local imports
-from config import app, db
-from models import User, Product,Category, Cart, CartItem, Order, OrderItem
+from config import app, db, use_replica
+import request_logging  # request ids, timing and the log queue; before the rate limit check
+from auth import revoke_current_token, revoke_refresh_token, revoke_refresh_token_string, role_required
+from cache import CatalogCache
+from carts import adjust_cart_totals, get_or_create_cart_id, refresh_cart_totals, refresh_carts_with_product, upsert_cart_item
+from idempotency import idempotent
+from images import IMAGE_URL_PATTERN, ImageError, ImageSupportMissing, attach_product_image, image_store, thumbnail_url
+from http_client import outbound
+from jobs import job_counts
+from mpesa import apply_stk_callback, queue_stk_push
+from passwords import PasswordHasherBusy, password_hasher
+from product_io import export_products, import_products
+import ratelimit  # registers the per-route rate limit check
+from models import User, Product,Category, Cart, CartItem, Order, OrderItem, Payment, PRODUCT_FTS_PREFIXES
 
 app.config['JWT_SECRET_KEY'] = 'your_jwt_secret_key_here'
 
-# Initialize Bcrypt and JWTManager
-bcrypt = Bcrypt(app)
-jwt = JWTManager(app)
-
-
-# M-Pesa credentials
-CONSUMER_KEY = 'EGUWDv8KcAgJQe08Gbgd0XDiJrmANJ7qV0SWwkxuh0aaGhnC'
-CONSUMER_SECRET = 'fXBG6h3MayGHakAnj0bc3FGosRquGcoGEazg3JwfjmRe9SzB1YwuqTWwliOVNpFq'
-SHORTCODE = '174379'
-PASSKEY = 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919'
-LIPA_NA_MPESA_URL = 'https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest'
-
-# Function to get access token
-def get_access_token():
-    url = 'https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials'
-    response = requests.get(url, auth=HTTPBasicAuth(CONSUMER_KEY, CONSUMER_SECRET))
-    json_response = response.json()
-    return json_response['access_token']
-
-# Function to generate the password for the STK push request
-def generate_password():
-    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-    password_str = SHORTCODE + PASSKEY + timestamp
-    password = base64.b64encode(password_str.encode()).decode('utf-8')
-    return password, timestamp
+# Cache for the storefront catalog reads, invalidated by the product write routes
+catalog_cache = CatalogCache(
+    max_entries=app.config['CATALOG_CACHE_SIZE'],
+    ttl=app.config['CATALOG_CACHE_TTL']
+)
+
+
+# Function to read the keyset pagination arguments (?limit=&after=)
+def get_page_args():
+    limit = request.args.get('limit', app.config['DEFAULT_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+    after = request.args.get('after', type=int)
+    return limit, after
+
+# Function to build the headers pointing at the next page of a listing
+def next_page_headers(rows, limit, cursor, param='after'):
+    if len(rows) <= limit:
+        return {}
+    next_cursor = cursor(rows[limit - 1])
+    args = request.args.to_dict()
+    args[param] = next_cursor
+    return {
+        'X-Next-Cursor': str(next_cursor),
+        'Link': f'<{request.path}?{urlencode(args)}>; rel="next"'
+    }
+
+# Product columns that can be selected with ?fields= on the product listing
+PRODUCT_FIELDS = {
+    'id': Product.id,
+    'name': Product.name,
+    'description': Product.description,
+    'price': Product.price,
+    'image_url': Product.image_url,
+    'thumbnail_url': Product.image_url,  # rewritten to the thumbnail variant below
+    'category': Category.name
+}
+
+# Function to serve a catalog read from the cache, building it on a miss.
+# build() returns a (body, status, headers) tuple of plain data; the body is
+# serialized once and stored with its headers. Successful responses get an ETag
+# hashed from the serialized body and headers, and a matching If-None-Match is
+# answered with 304 straight from the cache.
+def cached_catalog_response(build):
+    key = request.full_path
+    entry = catalog_cache.get(key)
+    cache_status = 'HIT'
+    if entry is None:
+        version = catalog_cache.version
+        body, status, headers = build()
+        data = app.json.dumps(body) + '\n'
+        if status == 200:
+            headers = {
+                **headers,
+                'ETag': f'"{catalog_cache.etag(data, headers.items())}"',
+                'Cache-Control': app.config['CATALOG_CACHE_CONTROL']
+            }
+        entry = (data, status, headers)
+        catalog_cache.set(key, entry, version)
+        cache_status = 'MISS'
+
+    data, status, headers = entry
+    etag = headers.get('ETag')
+    if etag and request.if_none_match.contains(etag.strip('"')):
+        return app.response_class(status=304, headers={
+            'ETag': etag,
+            'Cache-Control': headers['Cache-Control'],
+            'X-Cache': cache_status
+        })
+
+    return app.response_class(data, status=status, headers={**headers, 'X-Cache': cache_status}, mimetype='application/json')
+
+# Function to answer when the password workers are saturated
+def busy_response():
+    return jsonify({'message': 'Server busy, please retry shortly'}), 503, {'Retry-After': '1'}
+
 # Views go here!
 
 @app.route('/')
@@ -66,8 +130,11 @@ def register():
     if existing_user:
         return jsonify({'message': 'Username already exists'}), 400
     
-    # Hash the password
-    hashed_password = bcrypt.generate_password_hash(data['password']).decode('utf-8')
+    # Hash the password in the worker pool
+    try:
+        hashed_password = password_hasher.hash(data['password'])
+    except PasswordHasherBusy:
+        return busy_response()
     
     # Create a new user instance
     new_user = User(
@@ -97,13 +164,29 @@ def login():
     user = User.query.filter_by(username=data['username']).first()
     
     # Check if user exists and password is correct
-    if user and bcrypt.check_password_hash(user.password, data['password']):
-        # Create JWT access token
-        access_token = create_access_token(identity={'id': user.id, 'role': user.role})
+    try:
+        password_ok = user is not None and password_hasher.check(user.password, data['password'])
+    except PasswordHasherBusy:
+        return busy_response()
+
+    if password_ok:
+        # Upgrade the stored hash when the configured cost factor has changed
+        if password_hasher.needs_rehash(user.password):
+            try:
+                user.password = password_hasher.hash(data['password'])
+                db.session.commit()
+            except PasswordHasherBusy:
+                pass
+
+        # Create JWT access and refresh tokens
+        identity = {'id': user.id, 'role': user.role}
+        access_token = create_access_token(identity=identity)
+        refresh_token = create_refresh_token(identity=identity)
         
-        # Return the token and user info
+        # Return the tokens and user info
         return jsonify({
             'access_token': access_token,
+            'refresh_token': refresh_token,
             'id': user.id,
             'username': user.username,
             'email': user.email,
@@ -113,36 +196,197 @@ def login():
     
     return jsonify({'message': 'Invalid credentials'}), 401
 
+################################################################
+# Refresh route, trades a refresh token for a new access token and a new
+# refresh token. The old refresh token is revoked, so each one works once.
+@app.route("/refresh", methods=['POST'])
+@jwt_required(refresh=True)
+def refresh():
+    # Only one request can rotate a given refresh token
+    if not revoke_refresh_token(get_jwt()):
+        return jsonify({'message': 'Refresh token has already been used'}), 401
+
+    # Read the user again so a changed role or deleted account takes effect
+    user = db.session.get(User, get_jwt_identity()['id'])
+    if not user:
+        return jsonify({'message': 'User not found'}), 401
+
+    identity = {'id': user.id, 'role': user.role}
+    return jsonify({
+        'access_token': create_access_token(identity=identity),
+        'refresh_token': create_refresh_token(identity=identity)
+    }), 200
+
+################################################################
+# Logout route, revokes the access token used to call it and, when one is
+# sent in the body, the session's refresh token
+@app.route("/logout", methods=['POST'])
+@jwt_required()
+def logout():
+    revoke_current_token()
+
+    data = request.get_json(silent=True) or {}
+    if data.get('refresh_token'):
+        revoke_refresh_token_string(data['refresh_token'], get_jwt_identity()['id'])
+
+    return jsonify({'message': 'Logged out successfully'}), 200
+
 ################################################################
 # Get all products route
 @app.route("/products", methods=['GET'])
+@use_replica
 def get_all_products():
-    # Query all products from the database
-    products = Product.query.all()
-    
-    product_list = []
-    for product in products:
-        product_data = {
-            'id': product.id,
-            'name': product.name,
-            'description': product.description,
-            'price': product.price,
-            'image_url': product.image_url,
-            'category': product.category.name  
-        }
-        product_list.append(product_data)
-    
-    return jsonify(product_list), 200
+    return cached_catalog_response(list_products)
+
+def list_products():
+    limit, after = get_page_args()
+
+    # Work out which columns were requested (all of them by default)
+    fields = request.args.get('fields')
+    if fields:
+        field_names = [name.strip() for name in fields.split(',') if name.strip()]
+        unknown = [name for name in field_names if name not in PRODUCT_FIELDS]
+        if unknown:
+            return {'message': f'Unknown fields: {", ".join(unknown)}'}, 400, {}
+    else:
+        field_names = list(PRODUCT_FIELDS)
+
+    # Select one page of products ordered by id, joining the category name in the same query
+    columns = [PRODUCT_FIELDS[name].label(name) for name in field_names]
+    query = db.session.query(Product.id.label('cursor'), *columns)
+    if 'category' in field_names:
+        query = query.join(Category, Product.category_id == Category.id)
+    if after is not None:
+        query = query.filter(Product.id > after)
+    rows = query.order_by(Product.id).limit(limit + 1).all()
+
+    product_list = [
+        {name: getattr(row, name) for name in field_names}
+        for row in rows[:limit]
+    ]
+    if 'thumbnail_url' in field_names:
+        for product in product_list:
+            product['thumbnail_url'] = thumbnail_url(product['thumbnail_url'])
+
+    # The next page cursor is sent in headers so the body stays a plain list
+    headers = next_page_headers(rows, limit, lambda row: row.cursor)
+
+    return product_list, 200, headers
+
+####################################################################
+# Search products route (SQLite FTS5 over name and description)
+@app.route("/products/search", methods=['GET'])
+@use_replica
+def search_products():
+    return cached_catalog_response(find_products)
+
+# Match against the product_fts index. Every word of the query has to match,
+# and each word of SEARCH_MIN_PREFIX_LENGTH characters or more is treated as a
+# prefix so "dre flo" finds "Floral Dress"; words longer than the prefix index
+# are cut to its longest prefix. Products whose name matches come first, then
+# those matching through their description, newest first within each.
+#
+# bm25 ranking is not used: it has to count every match of each word, which for
+# broad words takes hundreds of milliseconds on a large catalog. This order
+# lets FTS5 stop each branch after offset + limit + 1 rows instead, since no
+# product beyond that could make the page. Paging stops after
+# SEARCH_MAX_RESULTS results, which bounds the cost of deep offsets.
+PRODUCT_SEARCH_SQL = '''
+    SELECT product.id, product.name, product.description, product.price,
+           product.image_url, category.name AS category
+    FROM (
+        SELECT id, MIN(tier) AS tier
+        FROM (
+            SELECT * FROM (
+                SELECT product_fts.rowid AS id, 0 AS tier
+                FROM product_fts {category_join}
+                WHERE product_fts MATCH :name_match {category_filter}
+                ORDER BY product_fts.rowid DESC
+                LIMIT :candidates
+            )
+            UNION ALL
+            SELECT * FROM (
+                SELECT product_fts.rowid AS id, 1 AS tier
+                FROM product_fts {category_join}
+                WHERE product_fts MATCH :match {category_filter}
+                ORDER BY product_fts.rowid DESC
+                LIMIT :candidates
+            )
+        )
+        GROUP BY id
+        ORDER BY tier, id DESC
+        LIMIT :limit OFFSET :offset
+    ) AS hits
+    JOIN product ON product.id = hits.id
+    JOIN category ON category.id = product.category_id
+    ORDER BY hits.tier, hits.id DESC
+'''
+
+# Function to turn one query word into an FTS5 phrase
+def search_phrase(term):
+    if len(term) < app.config['SEARCH_MIN_PREFIX_LENGTH']:
+        return f'"{term}"'
+    return f'"{term[:max(PRODUCT_FTS_PREFIXES)]}"*'
+
+def find_products():
+    # The product_fts index only exists on SQLite
+    if db.session.get_bind().dialect.name != 'sqlite':
+        return {'message': 'Product search is not available on this database'}, 501, {}
+
+    terms = re.findall(r'\w+', request.args.get('q', ''))
+    if not terms:
+        return {'message': 'A search query is required'}, 400, {}
+
+    limit, _ = get_page_args()
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    category_id = request.args.get('category_id', type=int)
+
+    max_results = app.config['SEARCH_MAX_RESULTS']
+    if offset >= max_results:
+        return {'message': f'Search results are limited to the first {max_results}, please refine the query'}, 400, {}
+    limit = min(limit, max_results - offset)
+    # One extra row tells whether there is a next page
+    page_size = limit + 1 if offset + limit < max_results else limit
+
+    match = ' '.join(search_phrase(term) for term in terms)
+    params = {
+        'match': match,
+        'name_match': f'name : ({match})',
+        'candidates': offset + page_size,
+        'limit': page_size,
+        'offset': offset
+    }
+    category_join = ''
+    category_filter = ''
+    if category_id is not None:
+        category_join = 'JOIN product ON product.id = product_fts.rowid'
+        category_filter = 'AND product.category_id = :category_id'
+        params['category_id'] = category_id
+
+    rows = db.session.execute(
+        text(PRODUCT_SEARCH_SQL.format(category_join=category_join, category_filter=category_filter)), params
+    ).mappings().all()
+
+    product_list = [
+        {**row, 'thumbnail_url': thumbnail_url(row['image_url'])}
+        for row in rows[:limit]
+    ]
+    headers = next_page_headers(rows, limit, lambda row: offset + limit, param='offset')
+
+    return product_list, 200, headers
 
 ####################################################################
 # Get product by ID route
 @app.route("/products/<int:id>", methods=['GET'])
+@use_replica
 def get_product_by_id(id):
+    return cached_catalog_response(lambda: load_product(id))
 
+def load_product(id):
     product = Product.query.get(id)
 
     if not product:
-        return jsonify({'message': 'Product not found'}), 404
+        return {'message': 'Product not found'}, 404, {}
     
     product_data = {
         'id': product.id,
@@ -153,22 +397,15 @@ def get_product_by_id(id):
         'category': product.category.name  
     }
 
-    return jsonify(product_data), 200
+    return product_data, 200, {}
 
 
 
 ###################################################################
 # Creating new product
 @app.route("/products", methods=['POST'])
-@jwt_required()
+@role_required('admin')
 def create_product():
-    # Get the identity of the current user
-    current_user = get_jwt_identity()
-    
-    # Check if the current user is an admin
-    if current_user['role'] != 'admin':
-        return jsonify({'message': 'Access denied. Admins only.'}), 403
-    
     # Get product data from the request
     data = request.get_json()
     if not data or 'name' not in data or 'description' not in data or 'price' not in data or 'category_id' not in data:
@@ -186,6 +423,7 @@ def create_product():
     # Save the product to the database
     db.session.add(new_product)
     db.session.commit()
+    catalog_cache.invalidate()
     
     return jsonify({'message': 'Product created successfully', 'product': {
         'id': new_product.id,
@@ -198,18 +436,108 @@ def create_product():
 
 
 
+###################################################################
+# Bulk import of products from an NDJSON or CSV request body (admin only)
+@app.route("/products/bulk", methods=['POST'])
+@role_required('admin')
+def bulk_import_products():
+    data_format = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if data_format not in ('ndjson', 'csv'):
+        return jsonify({'message': 'Format must be ndjson or csv'}), 400
+
+    # Rows are read from the body as it arrives and committed in batches
+    result = import_products(request.stream, data_format, batch_size=app.config['PRODUCT_IMPORT_BATCH_SIZE'])
+    if result['imported']:
+        catalog_cache.invalidate()
+
+    if 'failed' in result:
+        return jsonify(result), 500
+    return jsonify(result), 200 if result['imported'] or not result['rejected'] else 400
+
+
+###################################################################
+# Export of all products as NDJSON or CSV, streamed as rows are read (admin only)
+@app.route("/products/export", methods=['GET'])
+@role_required('admin')
+@use_replica
+def export_all_products():
+    data_format = request.args.get('format', 'ndjson')
+    if data_format not in ('ndjson', 'csv'):
+        return jsonify({'message': 'Format must be ndjson or csv'}), 400
+
+    mimetype = 'text/csv' if data_format == 'csv' else 'application/x-ndjson'
+    return app.response_class(
+        stream_with_context(export_products(data_format)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=products.{data_format}'}
+    )
+
+
+###################################################################
+# Upload an image for a product (admin only). Takes the image as a multipart
+# "image" file or as the raw request body.
+@app.route("/products/<int:product_id>/image", methods=['POST'])
+@role_required('admin')
+def upload_product_image(product_id):
+    product = db.session.get(Product, product_id)
+    if not product:
+        return jsonify({'message': 'Product not found'}), 404
+
+    if request.content_length and request.content_length > app.config['IMAGE_MAX_UPLOAD_BYTES']:
+        return jsonify({'message': 'Image is too large'}), 413
+
+    upload = request.files.get('image')
+    data = upload.read() if upload else request.get_data()
+    if not data:
+        return jsonify({'message': 'No image provided'}), 400
+
+    # Store the original and queue its resized variants with the product change
+    try:
+        urls = attach_product_image(product, data)
+    except ImageSupportMissing as error:
+        return jsonify({'message': str(error)}), 501
+    except ImageError as error:
+        return jsonify({'message': str(error)}), 400
+    db.session.commit()
+    catalog_cache.invalidate()
+
+    return jsonify({'message': 'Image uploaded successfully', 'image_url': product.image_url, 'variants': urls}), 201
+
+
+###################################################################
+# Serve a resized product image. The url names the original's content hash, so
+# the response never changes and can be cached for good.
+@app.route("/images/<digest>/<filename>", methods=['GET'])
+def get_image(digest, filename):
+    match = IMAGE_URL_PATTERN.match(request.path)
+    if not match or match.group(2) not in app.config['IMAGE_VARIANTS']:
+        return jsonify({'message': 'Image not found'}), 404
+    variant, extension = match.group(2), match.group(3)
+
+    try:
+        path = image_store.get_variant(digest, variant, extension)
+    except ImageSupportMissing as error:
+        return jsonify({'message': str(error)}), 501
+    if not path:
+        return jsonify({'message': 'Image not found'}), 404
+
+    # send_file answers If-None-Match and Range requests from the file
+    response = send_file(
+        path,
+        mimetype='image/webp' if extension == 'webp' else 'image/jpeg',
+        conditional=True,
+        max_age=app.config['IMAGE_MAX_AGE']
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 ################################################################
 # updating products
 @app.route("/products/<int:product_id>", methods=['PUT'])
-@jwt_required()
+@role_required('admin')
 def update_product(product_id):
-    # Get the identity of the current user
-    current_user = get_jwt_identity()
-    
-    # Check if the current user is an admin
-    if current_user['role'] != 'admin':
-        return jsonify({'message': 'Access denied. Admins only.'}), 403
-    
     # Get product data from the request
     data = request.get_json()
     
@@ -220,14 +548,21 @@ def update_product(product_id):
         return jsonify({'message': 'Product not found'}), 404
     
     # Update product fields if provided in the request
+    old_price = product.price
     product.name = data.get('name', product.name)
     product.description = data.get('description', product.description)
     product.price = data.get('price', product.price)
     product.image_url = data.get('image_url', product.image_url)
     product.category_id = data.get('category_id', product.category_id)
+
+    # A new price changes the subtotal of every cart holding the product
+    if product.price != old_price:
+        db.session.flush()
+        refresh_carts_with_product(product.id)
     
     # Save changes to the database
     db.session.commit()
+    catalog_cache.invalidate()
     
     return jsonify({'message': 'Product updated successfully', 'product': {
         'id': product.id,
@@ -243,15 +578,8 @@ def update_product(product_id):
 ########################################################################
 # deleting products
 @app.route("/products/<int:product_id>", methods=['DELETE'])
-@jwt_required()
+@role_required('admin')
 def delete_product(product_id):
-    # Get the identity of the current user from the JWT
-    current_user = get_jwt_identity()
-    
-    # Check if the current user has the admin role
-    if current_user['role'] != 'admin':
-        return jsonify({'message': 'Access denied. Admins only.'}), 403
-    
     # Retrieve the product by its ID
     product = Product.query.get(product_id)
     
@@ -259,10 +587,19 @@ def delete_product(product_id):
     if not product:
         return jsonify({'message': 'Product not found'}), 404
     
+    # Orders keep pointing at the products they were placed for
+    if db.session.query(OrderItem.id).filter_by(product_id=product.id).first():
+        return jsonify({'message': 'Product has been ordered and can not be deleted'}), 409
+    
+    # Take the product out of carts first and recompute those carts' totals
+    cart_ids = [cart_id for (cart_id,) in db.session.query(CartItem.cart_id).filter_by(product_id=product.id).distinct()]
+    CartItem.query.filter_by(product_id=product.id).delete(synchronize_session=False)
+    refresh_cart_totals(cart_ids)
     
     # Delete the product from the database
     db.session.delete(product)
     db.session.commit()
+    catalog_cache.invalidate()
     
     # Return a success message
     return jsonify({'message': f'Product "{product.name}" has been deleted successfully.'}), 200
@@ -273,58 +610,129 @@ def delete_product(product_id):
 @app.route("/cart", methods=['POST'])
 @jwt_required()
 def add_to_cart():
-    print("Add to cart")
     # Get the identity of the current user
     current_user = get_jwt_identity()
-
-    print("Current user", current_user)
     
     # Get the product data from the request
     data = request.get_json()
-    print("data")
-    print("Received data: ", data)
-    print("Received data: ", request.get_json())
     # Validate the input data
     if not data or 'product_id' not in data or 'quantity' not in data:
         return jsonify({'message': 'Invalid data provided'}), 400
     
-    # Find the product by ID
-    product = Product.query.get(data['product_id'])
-    
-    if not product:
-        return jsonify({'message': 'Product not found'}), 404
-    
     # Check if the quantity is valid
-    if data['quantity'] <= 0:
+    if not isinstance(data['quantity'], int) or data['quantity'] <= 0:
         return jsonify({'message': 'Invalid quantity'}), 400
     
-
-    cart = Cart(
-            user_id=current_user['id']
-        )
-    db.session.add(cart)
-    
-    # Check if the product is already in the user's cart
-    cart_item = CartItem.query.filter_by(user_id=current_user['id'], product_id=product.id).first()
+    # Find the product's price by ID
+    price = db.session.query(Product.price).filter_by(id=data['product_id']).scalar()
     
-    if cart_item:
-        # If the product is already in the cart, update the quantity
-        cart_item.quantity += data['quantity']
-    else:
-        # If the product is not in the cart, create a new CartItem
-        cart_item = CartItem(
-            cart_id=cart.id,
-            user_id=current_user['id'],
-            product_id=product.id,
-            quantity=data['quantity']
-        )
-        db.session.add(cart_item)
+    if price is None:
+        return jsonify({'message': 'Product not found'}), 404
+
+    # Add the product to the user's single cart, or increase its quantity if it
+    # is already there, and keep the cart's stored totals in step
+    cart_id = get_or_create_cart_id(current_user['id'])
+    upsert_cart_item(current_user['id'], cart_id, data['product_id'], data['quantity'])
+    adjust_cart_totals(cart_id, data['quantity'], data['quantity'] * price)
     
     # Commit the changes to the database
     db.session.commit()
     
     return jsonify({'message': 'Product added to cart successfully'}), 201
 
+#######################################################################
+# Route to apply several cart changes at once, for clients syncing a local cart.
+# Takes {"operations": [...]} where each operation is
+#   {"op": "add", "product_id": 1, "quantity": 2}     adds to the quantity
+#   {"op": "set", "product_id": 1, "quantity": 5}     sets the quantity
+#   {"op": "remove", "product_id": 1}                 removes the product
+# All operations are applied in one transaction, or none if one is invalid,
+# and the response is the updated cart.
+@app.route("/cart", methods=['PATCH'])
+@jwt_required()
+@idempotent
+def update_cart_batch():
+    user_id = get_jwt_identity()['id']
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({'message': 'A list of operations is required'}), 400
+    if len(operations) > app.config['CART_BATCH_MAX_OPERATIONS']:
+        return jsonify({'message': f"At most {app.config['CART_BATCH_MAX_OPERATIONS']} operations are allowed"}), 400
+
+    # Validate every operation before changing anything
+    for index, operation in enumerate(operations):
+        if not isinstance(operation, dict) or operation.get('op') not in ('add', 'set', 'remove'):
+            return jsonify({'message': 'Unknown operation', 'operation': index}), 400
+        if not isinstance(operation.get('product_id'), int):
+            return jsonify({'message': 'Invalid product_id', 'operation': index}), 400
+        if operation['op'] != 'remove' and (not isinstance(operation.get('quantity'), int) or operation['quantity'] < 1):
+            return jsonify({'message': 'Invalid quantity', 'operation': index}), 400
+
+    # Check all the products exist with one query
+    product_ids = {operation['product_id'] for operation in operations}
+    found = {product_id for (product_id,) in db.session.query(Product.id).filter(Product.id.in_(product_ids))}
+    for index, operation in enumerate(operations):
+        if operation['op'] != 'remove' and operation['product_id'] not in found:
+            return jsonify({'message': 'Product not found', 'operation': index}), 404
+
+    try:
+        cart_id = get_or_create_cart_id(user_id)
+        for operation in operations:
+            if operation['op'] == 'remove':
+                CartItem.query.filter_by(cart_id=cart_id, product_id=operation['product_id']).delete(synchronize_session=False)
+            else:
+                upsert_cart_item(user_id, cart_id, operation['product_id'], operation['quantity'], replace=operation['op'] == 'set')
+
+        # Recompute the cart's stored totals once for the whole batch
+        refresh_cart_totals([cart_id])
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        return jsonify({'message': 'Could not update cart'}), 500
+
+    return jsonify(load_cart(user_id)), 200
+
+#######################################################################
+# Function to load a user's cart with its items and total.
+# Costs two queries however many items the cart holds: one for the cart
+# and one joining the cart items to their products.
+def load_cart(user_id):
+    cart = Cart.query.filter_by(user_id=user_id).first()
+
+    if not cart:
+        return None
+
+    rows = db.session.query(
+        CartItem.id,
+        CartItem.quantity,
+        Product.id.label('product_id'),
+        Product.name,
+        Product.description,
+        Product.price,
+        Product.image_url
+    ).join(Product, CartItem.product_id == Product.id).filter(
+        CartItem.user_id == user_id
+    ).order_by(CartItem.id).all()
+
+    cart_items = [{
+        'item_id': row.id,
+        'product_id': row.product_id,
+        'name': row.name,
+        'description': row.description,
+        'price': row.price,
+        'quantity': row.quantity,
+        'image_url': row.image_url,
+        'thumbnail_url': thumbnail_url(row.image_url)
+    } for row in rows]
+
+    return {
+        'cart_id': cart.id,
+        'total_price': round(sum(row.price * row.quantity for row in rows), 2),
+        'items': cart_items
+    }
+
 #######################################################################
 #getting products in cart
 @app.route('/cart', methods=['GET'])
@@ -332,38 +740,37 @@ def add_to_cart():
 def get_cart():
     try:
         current_user_id = get_jwt_identity()
-        print(f"Current User ID: {current_user_id}")
         
-        cart = Cart.query.filter_by(user_id=current_user_id['id']).first()
-        print(cart.id)
-        cart_detail = CartItem.query.filter_by(user_id=current_user_id['id']).all()
+        cart_data = load_cart(current_user_id['id'])
         
-        if not cart:
+        if not cart_data:
             return jsonify({"message": "Cart is empty"}), 200
         
-        cart_items = []
-        for item in cart_detail:
-            product = Product.query.get(item.product_id)
-            cart_items.append({
-                'product_id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'price': product.price,
-                'quantity': item.quantity,
-                'image_url': product.image_url
-            })
-        
-        return jsonify({
-            'cart_id': cart.id,
-            'total_price': cart.user_id,
-            'items': cart_items
-        }), 200
+        return jsonify(cart_data), 200
 
     except Exception as e:
-        print(f"Error fetching cart: {str(e)}")
+        app.logger.exception('Error fetching cart')
         return jsonify({"message": "Error fetching cart", "error": str(e)}), 422
 
 
+#######################################################################
+# Route for the cart badge and checkout summary, read from the stored totals
+@app.route('/cart/summary', methods=['GET'])
+@jwt_required()
+def get_cart_summary():
+    user_id = get_jwt_identity()['id']
+
+    item_count, subtotal = db.session.query(
+        func.coalesce(func.sum(Cart.item_count), 0),
+        func.coalesce(func.sum(Cart.subtotal), 0)
+    ).filter(Cart.user_id == user_id).one()
+
+    return jsonify({
+        'item_count': item_count,
+        'subtotal': round(subtotal, 2)
+    }), 200
+
+
 
 ###################################################################
 # Route to update the quantity of an item in the cart
@@ -374,27 +781,23 @@ def update_cart_item(item_id):
     # Get the current user from the JWT token
     current_user_id = get_jwt_identity()
     
-    # Find the user's cart
-    cart = Cart.query.filter_by(user_id=current_user_id).first()
-    
-    if not cart:
-        return jsonify({"message": "Cart not found"}), 404
-    
-    # Find the cart item by ID
-    cart_item = CartItem.query.filter_by(id=item_id, cart_id=cart.id).first()
+    # Find the cart item by ID among the user's items
+    cart_item = CartItem.query.filter_by(id=item_id, user_id=current_user_id['id']).first()
     
     if not cart_item:
         return jsonify({"message": "Cart item not found"}), 404
     
     # Get the new quantity from the request data
-    data = request.get_json()
+    data = request.get_json() or {}
     new_quantity = data.get('quantity')
     
-    if not new_quantity or new_quantity < 1:
+    if not isinstance(new_quantity, int) or new_quantity < 1:
         return jsonify({"message": "Invalid quantity provided"}), 400
     
-    # Update the quantity of the cart item
+    # Update the quantity of the cart item and the cart's totals
+    change = new_quantity - cart_item.quantity
     cart_item.quantity = new_quantity
+    adjust_cart_totals(cart_item.cart_id, change, change * cart_item.product.price)
     db.session.commit()
     
     return jsonify({
@@ -413,19 +816,14 @@ def remove_cart_item(item_id):
     # Get the current user from the JWT token
     current_user_id = get_jwt_identity()
     
-    # Find the user's cart
-    cart = Cart.query.filter_by(user_id=current_user_id['id']).first()
-    
-    if not cart:
-        return jsonify({"message": "Cart not found"}), 404
+    # Find the cart item by ID among the user's items
+    cart_item = CartItem.query.filter_by(id=item_id, user_id=current_user_id['id']).first()
     
-    # Find the cart item by ID
-    cart_item = CartItem.query.filter_by(id=item_id).first()
-    
-    # if not cart_item:
-    #     return jsonify({"message": "Cart item not found"}), 404
+    if not cart_item:
+        return jsonify({"message": "Cart item not found"}), 404
     
-    # Remove the cart item from the database
+    # Remove the cart item from the database and from the cart's totals
+    adjust_cart_totals(cart_item.cart_id, -cart_item.quantity, -cart_item.quantity * cart_item.product.price)
     db.session.delete(cart_item)
     db.session.commit()
     
@@ -435,19 +833,27 @@ def remove_cart_item(item_id):
 #######################################################################
 #getting categories
 @app.route('/api/categories', methods=['GET'])
+@use_replica
 def get_categories():
+    return cached_catalog_response(list_categories)
+
+def list_categories():
     categories = Category.query.all()
     category_list = [{'id': c.id, 'name': c.name} for c in categories]
-    return jsonify(category_list)
+    return category_list, 200, {}
 
 
 #######################################################################
 # getting products by category
 @app.route('/api/categories/<int:category_id>/products', methods=['GET'])
+@use_replica
 def get_products_by_category(category_id):
+    return cached_catalog_response(lambda: list_category_products(category_id))
+
+def list_category_products(category_id):
     category = Category.query.get(category_id)
     if not category:
-        return jsonify({'message': 'Category not found'}), 404
+        return {'message': 'Category not found'}, 404, {}
 
     products = Product.query.filter_by(category_id=category_id).all()
     product_list = [{
@@ -456,28 +862,47 @@ def get_products_by_category(category_id):
         'description': p.description,
         'price': p.price,
         'image_url': p.image_url,
+        'thumbnail_url': thumbnail_url(p.image_url),
         'category': {'id': category.id, 'name': category.name}
     } for p in products]
 
-    return jsonify(product_list), 200
+    return product_list, 200, {}
 
 ###########################################################
 # Creating an order
 
 @app.route('/orders', methods=['POST'])
 @jwt_required()
+@idempotent
 def create_order():
     # Get the current user from the JWT token
     current_user_id = get_jwt_identity()
-    data = request.get_json()
-    print(data)
+    data = request.get_json() or {}
 
     # Find the user's cart
-    cart = Cart.query.filter_by(user_id=current_user_id['id'], id=data['cart_id']).first()
+    cart_query = Cart.query.filter_by(user_id=current_user_id['id'])
+    if data.get('cart_id'):
+        cart_query = cart_query.filter_by(id=data['cart_id'])
+    cart = cart_query.first()
 
     if not cart :
         return jsonify({"message": "Cart is empty or not found"}), 404
 
+    # Read the cart items with their current prices in one query.
+    # Items and prices always come from the database, never from the client.
+    cart_rows = db.session.query(
+        CartItem.id,
+        CartItem.cart_id,
+        CartItem.product_id,
+        CartItem.quantity,
+        Product.price
+    ).join(Product, CartItem.product_id == Product.id).filter(
+        CartItem.user_id == current_user_id['id']
+    ).all()
+
+    if not cart_rows:
+        return jsonify({"message": "Cart is empty or not found"}), 404
+
     # Get billing and shipping information from request
 
     # billing_address = data.get('billing_address')
@@ -487,50 +912,88 @@ def create_order():
     #     return jsonify({"message": "Billing and shipping addresses are required"}), 400
 
     # Calculate the total price
-    # total_price = cart.total_price
-
-    # Create a new order
-    new_order = Order(
-        user_id=current_user_id['id'],
-        cart_id=data['cart_id'],
-        total_price=data['grandTotal'],
-        # billing_address=billing_address,
-        # shipping_address=shipping_address
-    )
-    db.session.add(new_order)
-    db.session.commit()
+    total_price = round(sum(row.price * row.quantity for row in cart_rows), 2)
 
-    # Create order items based on cart items
-    for item in data['cartItems']:
-        order_item = OrderItem(
-            order_id=new_order.id,
-            product_id=item['product_id'],
-            quantity=item['quantity']
+    # The order, its items and clearing the cart are committed as one transaction
+    try:
+        # Create a new order
+        new_order = Order(
+            user_id=current_user_id['id'],
+            cart_id=cart.id,
+            total_price=total_price,
+            # billing_address=billing_address,
+            # shipping_address=shipping_address
         )
-        db.session.add(order_item)
+        db.session.add(new_order)
+        db.session.flush()  # assigns the order id
+        order_id = new_order.id
+
+        # Create order items based on cart items, in a single bulk insert
+        db.session.execute(insert(OrderItem), [{
+            'order_id': order_id,
+            'product_id': row.product_id,
+            'quantity': row.quantity
+        } for row in cart_rows])
+
+        # Clear the cart after the order is placed (only the items that were ordered).
+        # The cart was read before this transaction took the write lock, so a
+        # checkout of the same cart may have committed in between; then some of
+        # the items are already gone and this order must not be placed.
+        deleted = db.session.query(CartItem).filter(
+            CartItem.id.in_([row.id for row in cart_rows])
+        ).delete(synchronize_session=False)
+        if deleted != len(cart_rows):
+            db.session.rollback()
+            return jsonify({"message": "The cart changed while the order was being placed"}), 409
+        refresh_cart_totals(list({row.cart_id for row in cart_rows}))
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        return jsonify({"message": "Could not create order"}), 500
 
-    # Clear the cart after the order is placed
-    db.session.query(CartItem).filter_by(cart_id=cart.id).delete()
-    db.session.commit()
+    return jsonify({
+        "message": "Order created successfully",
+        "order_id": order_id,
+        "total_price": total_price
+    }), 201
+
+######################################################################
+# Function to apply the ?status=, ?from= and ?to= filters to an order query and
+# fetch one page of it, newest first. ?from= is inclusive and ?to= exclusive,
+# both ISO dates or datetimes. Raises ValueError for a malformed date.
+def page_of_orders(query):
+    limit, after = get_page_args()
 
-    return jsonify({"message": "Order created successfully", "order_id": new_order.id}), 201
+    status = request.args.get('status')
+    if status:
+        query = query.filter(Order.status == status)
+
+    date_from = request.args.get('from')
+    if date_from:
+        query = query.filter(Order.created_at >= datetime.datetime.fromisoformat(date_from))
+
+    date_to = request.args.get('to')
+    if date_to:
+        query = query.filter(Order.created_at < datetime.datetime.fromisoformat(date_to))
+
+    # Orders are listed by descending id, so the cursor moves towards smaller ids
+    if after is not None:
+        query = query.filter(Order.id < after)
+
+    orders = query.order_by(Order.id.desc()).limit(limit + 1).all()
+    return orders[:limit], next_page_headers(orders, limit, lambda order: order.id)
 
 ######################################################################
 # Route to view all orders (admin only)
 @app.route('/orders', methods=['GET'])
-@jwt_required()
+@role_required('admin')
+@use_replica
 def view_all_orders():
-    # Get the current user from the JWT token
-    current_user_id = get_jwt_identity()
-
-    # Find the current user
-    current_user = User.query.get(current_user_id)
-
-    if not current_user or current_user.role != 'admin':
-        return jsonify({"message": "Access denied. Admins only."}), 403
-
-    # Retrieve all orders
-    orders = Order.query.all()
+    # Retrieve one page of orders, loading all their items in one extra query
+    try:
+        orders, headers = page_of_orders(Order.query.options(selectinload(Order.items)))
+    except ValueError:
+        return jsonify({"message": "Invalid date provided"}), 400
 
     # Serialize the orders into a list of dictionaries
     orders_data = []
@@ -540,6 +1003,7 @@ def view_all_orders():
             "user_id": order.user_id,
             "total_price": order.total_price,
             "status": order.status,
+            "created_at": order.created_at.isoformat() if order.created_at else None,
             "billing_address": order.billing_address,
             "shipping_address": order.shipping_address,
             "items": [
@@ -550,7 +1014,7 @@ def view_all_orders():
             ]
         })
 
-    return jsonify({"orders": orders_data}), 200
+    return jsonify({"orders": orders_data}), 200, headers
 
 
 
@@ -558,15 +1022,23 @@ def view_all_orders():
 # Route to allow logged-in users to view their orders
 @app.route('/orders/my-orders', methods=['GET'])
 @jwt_required()
+@use_replica
 def get_my_orders():
 
     # Get the current user's identity (id)
     user_id = get_jwt_identity()['id']
 
-    # Query the orders related to the logged-in user
-    orders = Order.query.filter_by(user_id=user_id).all()
+    # Query one page of the orders related to the logged-in user, with their items and products
+    query = Order.query.filter_by(user_id=user_id).options(
+        selectinload(Order.items).joinedload(OrderItem.product)
+    )
+    try:
+        orders, headers = page_of_orders(query)
+    except ValueError:
+        return jsonify({"message": "Invalid date provided"}), 400
 
-    if not orders:
+    # A filtered or later page may be empty; only a user with no orders at all gets a 404
+    if not orders and not any(name in request.args for name in ('after', 'status', 'from', 'to')):
         return jsonify({"message": "No orders found."}), 404
 
     # Serialize the orders
@@ -576,6 +1048,7 @@ def get_my_orders():
             "order_id": order.id,
             "total_price": order.total_price,
             "status": order.status,
+            "created_at": order.created_at.isoformat() if order.created_at else None,
             "billing_address": order.billing_address,
             "shipping_address": order.shipping_address,
             "items": [
@@ -589,19 +1062,22 @@ def get_my_orders():
         }
         serialized_orders.append(serialized_order)
 
-    return jsonify(serialized_orders), 200
+    return jsonify(serialized_orders), 200, headers
 
 
 ##############################################################
 # Route to allow logged-in users to view the details of a specific order
 @app.route('/order/<int:order_id>', methods=['GET'])
 @jwt_required()
+@use_replica
 def get_order_details(order_id):
     # Get the current user's identity (id)
     user_id = get_jwt_identity()['id']
 
     # Query the specific order by order_id and ensure it belongs to the logged-in user
-    order = Order.query.filter_by(id=order_id, user_id=user_id).first()
+    order = Order.query.filter_by(id=order_id, user_id=user_id).options(
+        selectinload(Order.items).joinedload(OrderItem.product)
+    ).first()
 
     if not order:
         return jsonify({"message": "Order not found or you don't have access to this order."}), 404
@@ -611,6 +1087,7 @@ def get_order_details(order_id):
         "order_id": order.id,
         "total_price": order.total_price,
         "status": order.status,
+        "created_at": order.created_at.isoformat() if order.created_at else None,
         "billing_address": order.billing_address,
         "shipping_address": order.shipping_address,
         "items": [
@@ -627,38 +1104,105 @@ def get_order_details(order_id):
 
 
 @app.route('/mpesa/stk_push', methods=['POST'])
+@jwt_required()
+@idempotent
 def stk_push():
-    data = request.get_json()
+    user_id = get_jwt_identity()['id']
+    data = request.get_json() or {}
     amount = data.get('total_price')
     phone_number = data.get('phone_number')
+    order_id = data.get('order_id')
 
-    access_token = get_access_token()
-    password, timestamp = generate_password()
-    # timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    if not phone_number:
+        return jsonify({'message': 'Phone number is required'}), 400
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
+    # When paying for an order the amount comes from the order itself
+    if order_id is not None:
+        order = Order.query.filter_by(id=order_id, user_id=user_id).first()
+        if not order:
+            return jsonify({'message': 'Order not found'}), 404
+        amount = order.total_price
 
-    payload = {
-        'BusinessShortCode': SHORTCODE,
-        'Password': password,
-        'Timestamp': timestamp,
-        'TransactionType': 'CustomerPayBillOnline',
-        'Amount': amount,
-        'PartyA': phone_number,
-        'PartyB': SHORTCODE,
-        'PhoneNumber': phone_number,
-        'CallBackURL': 'https://www.google.com/',
-        'AccountReference': 'Test123',
-        'TransactionDesc': 'Payment for Goods'
-    }
-    print(payload)
+    if not isinstance(amount, (int, float)) or amount <= 0:
+        return jsonify({'message': 'Invalid amount provided'}), 400
+
+    payment = Payment(order_id=order_id, user_id=user_id, phone_number=str(phone_number), amount=amount)
+    db.session.add(payment)
+    db.session.flush()
 
-    response = requests.post(LIPA_NA_MPESA_URL, json=payload, headers=headers)
-    #  Update OrderStatus
-    return jsonify(response.json(), 200)
+    # Safaricom is called from a background job; the client polls the payment for the result.
+    # The job is committed together with the payment so neither exists without the other.
+    queue_stk_push(payment.id)
+    db.session.commit()
+
+    return jsonify({
+        'message': 'Payment initiated',
+        'payment_id': payment.id,
+        'status': payment.status
+    }), 202, {'Location': f'/mpesa/payments/{payment.id}'}
+
+
+##############################################################
+# Route Safaricom posts STK push results to
+@app.route('/mpesa/callback', methods=['POST'])
+def mpesa_callback():
+    # Only requests carrying the callback token are accepted. Without a token
+    # configured, callbacks are only accepted in development.
+    callback_token = app.config['MPESA_CALLBACK_TOKEN']
+    if callback_token:
+        accepted = hmac.compare_digest(request.args.get('token', ''), callback_token)
+    else:
+        accepted = not app.config['MPESA_CALLBACK_TOKEN_REQUIRED']
+        if not accepted:
+            app.logger.error('M-Pesa callback refused: MPESA_CALLBACK_TOKEN is not configured')
+    if not accepted:
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Rejected'}), 403
+
+    data = request.get_json(silent=True) or {}
+    callback = data.get('Body', {}).get('stkCallback')
+    if not callback or 'CheckoutRequestID' not in callback or 'ResultCode' not in callback:
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Invalid callback'}), 400
+
+    # Update the payment and its order's status
+    apply_stk_callback(callback)
+
+    return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'}), 200
+
+
+##############################################################
+# Route to poll the status of a payment, for the user who started it (or an admin)
+@app.route('/mpesa/payments/<int:payment_id>', methods=['GET'])
+@jwt_required()
+def get_payment_status(payment_id):
+    current_user = get_jwt_identity()
+    query = Payment.query.filter_by(id=payment_id)
+    if current_user.get('role') != 'admin':
+        query = query.filter_by(user_id=current_user['id'])
+    payment = query.first()
+
+    if not payment:
+        return jsonify({'message': 'Payment not found'}), 404
+
+    return jsonify({
+        'payment_id': payment.id,
+        'order_id': payment.order_id,
+        'amount': payment.amount,
+        'status': payment.status,
+        'result_description': payment.result_description,
+        'mpesa_receipt': payment.mpesa_receipt
+    }), 200
+
+
+##############################################################
+# Route to view runtime metrics such as catalog cache hits (admin only)
+@app.route('/admin/metrics', methods=['GET'])
+@role_required('admin')
+def view_metrics():
+    return jsonify({
+        'catalog_cache': catalog_cache.stats(),
+        'outbound': outbound.metrics(),
+        'jobs': job_counts()
+    }), 200
 
 
 if __name__ == '__main__':
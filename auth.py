@@ -0,0 +1,155 @@
+# Standard library imports
+from datetime import datetime
+from functools import wraps
+import threading
+import time
+
+# Remote library imports
+from flask import jsonify
+from flask_jwt_extended import JWTManager, decode_token, get_jwt, get_jwt_identity, verify_jwt_in_request
+from sqlalchemy.exc import IntegrityError
+
+# Local imports
+from config import app, db
+from models import RevokedToken, User
+
+jwt = JWTManager(app)
+
+
+# Revoked access tokens, by jti, until they would have expired anyway.
+# Kept in process memory so verifying an access token stays free of queries;
+# with several workers a logout is only enforced by the worker that handled it,
+# which the short access token lifetime bounds. Refresh tokens are revoked in
+# the revoked_token table instead.
+class TokenDenylist:
+
+    def __init__(self):
+        self._revoked = {}
+        self._lock = threading.Lock()
+
+    def add(self, jti, expires_at):
+        with self._lock:
+            self._revoked[jti] = expires_at
+            self._purge()
+
+    def __contains__(self, jti):
+        expires_at = self._revoked.get(jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def _purge(self):
+        now = time.time()
+        for jti in [jti for jti, expires_at in self._revoked.items() if expires_at <= now]:
+            del self._revoked[jti]
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+denylist = TokenDenylist()
+
+
+@jwt.token_in_blocklist_loader
+def is_token_revoked(jwt_header, jwt_payload):
+    if jwt_payload.get('type') == 'refresh':
+        return db.session.get(RevokedToken, jwt_payload['jti']) is not None
+    return jwt_payload['jti'] in denylist
+
+
+# Function to revoke the token of the current request
+def revoke_current_token():
+    claims = get_jwt()
+    if claims.get('type') == 'refresh':
+        return revoke_refresh_token(claims)
+    denylist.add(claims['jti'], claims.get('exp', float('inf')))
+    return True
+
+
+# Function to revoke a refresh token from its claims. Returns False when it was
+# already revoked; the primary key insert makes this safe when two requests
+# race to rotate the same token.
+def revoke_refresh_token(claims):
+    now = datetime.utcnow()
+    identity = claims.get(app.config.get('JWT_IDENTITY_CLAIM', 'sub'))
+
+    # Forget revocations of tokens that have expired anyway
+    RevokedToken.query.filter(RevokedToken.expires_at < now).delete(synchronize_session=False)
+    db.session.add(RevokedToken(
+        jti=claims['jti'],
+        user_id=identity.get('id') if isinstance(identity, dict) else None,
+        expires_at=datetime.utcfromtimestamp(claims['exp']) if 'exp' in claims else datetime.max
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+# Function to revoke a refresh token handed over in a request body, if it is
+# valid and belongs to user_id
+def revoke_refresh_token_string(token, user_id):
+    try:
+        claims = decode_token(token)
+    except Exception:
+        return False
+    identity = claims.get(app.config.get('JWT_IDENTITY_CLAIM', 'sub'))
+    if claims.get('type') != 'refresh' or not isinstance(identity, dict) or identity.get('id') != user_id:
+        return False
+    return revoke_refresh_token(claims)
+
+
+# Short-lived cache of user records, for the routes that must see the user's
+# current role rather than the one in their token
+class UserCache:
+
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        user = db.session.get(User, user_id)
+        record = {'id': user.id, 'username': user.username, 'role': user.role} if user else None
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.clear()
+            self._entries[user_id] = (time.monotonic() + self.ttl, record)
+        return record
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+user_cache = UserCache(ttl=app.config['USER_CACHE_TTL'])
+
+
+# Decorator for routes limited to some roles. Checks the role claim of the
+# access token, so no query is made; with fresh=True the role is read from the
+# (briefly cached) user record instead, for routes that must notice a role
+# change before the token expires. Replaces @jwt_required().
+def role_required(*roles, fresh=False):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            verify_jwt_in_request()
+            identity = get_jwt_identity()
+
+            role = identity.get('role') if isinstance(identity, dict) else None
+            if fresh and isinstance(identity, dict):
+                user = user_cache.get(identity.get('id'))
+                role = user['role'] if user else None
+
+            if role not in roles:
+                if roles == ('admin',):
+                    return jsonify({'message': 'Access denied. Admins only.'}), 403
+                return jsonify({'message': 'Access denied.'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
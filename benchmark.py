@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the hot paths of the API, run with Flask's test client:
+#
+#     python benchmark.py products [--products 100000] [--requests 500] [--baseline-requests 5]
+#     python benchmark.py search [--products 500000] [--requests 200] [--budget-ms 10]
+#     python benchmark.py concurrency [--writers 4] [--readers 8] [--seconds 10]
+#     python benchmark.py login [--threads 16] [--seconds 10]
+#
+# Each run builds its own SQLite database in a temporary directory, so the app
+# database is never touched, and prints latency percentiles. Set APP_ENV to
+# benchmark another environment's SQLite and pool settings.
+
+# Standard library imports
+import argparse
+from collections import Counter
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import warnings
+
+# The app reads its settings from the environment when it is imported
+BENCHMARK_DIRECTORY = tempfile.mkdtemp(prefix='allayne-benchmark-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(BENCHMARK_DIRECTORY, 'benchmark.db')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+# Remote library imports
+from flask import jsonify
+from flask_jwt_extended import create_access_token
+from jwt.warnings import InsecureKeyLengthWarning
+from sqlalchemy import event
+
+# Local imports
+from app import app, catalog_cache
+from config import db
+from models import Category, Product, User
+from passwords import password_hasher
+from product_io import insert_product_rows
+
+# Identities are {'id', 'role'} dicts, which newer PyJWT versions only accept
+# as the subject claim when it is not verified
+app.config['JWT_VERIFY_SUB'] = False
+# The development signing key is short; that is not what is being measured
+warnings.filterwarnings('ignore', category=InsecureKeyLengthWarning)
+
+WORDS = [
+    'floral', 'dress', 'denim', 'jeans', 'summer', 'maxi', 'crop', 'top', 'boots', 'heels',
+    'set', 'lounge', 'silk', 'cotton', 'linen', 'red', 'blue', 'black', 'white', 'green'
+]
+
+BENCHMARKS = {}
+
+
+# Decorator registering a benchmark under a name; keyword arguments are its
+# options and their defaults
+def benchmark(name, **options):
+    def decorator(function):
+        BENCHMARKS[name] = (function, options)
+        return function
+    return decorator
+
+
+# Function to get a percentile of request timings (in seconds) in milliseconds
+def percentile(timings, fraction):
+    timings = sorted(timings)
+    return round(timings[min(int(len(timings) * fraction), len(timings) - 1)] * 1000, 2)
+
+
+# Function to summarise request timings (in seconds) as milliseconds
+def summary(timings):
+    return (f'{len(timings)} requests, mean {round(statistics.mean(timings) * 1000, 2)} ms, '
+            f'p50 {percentile(timings, 0.50)} ms, p95 {percentile(timings, 0.95)} ms, '
+            f'p99 {percentile(timings, 0.99)} ms')
+
+
+# Function to create an empty schema
+def create_schema():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+# Function to create the schema and `count` products spread over six categories
+def create_catalog(count):
+    random.seed(1)
+    create_schema()
+    with app.app_context():
+        categories = [Category(name=name) for name in ('Denims', 'Dresses', 'Tops', 'Bottoms', 'Shoes', 'Sets')]
+        db.session.add_all(categories)
+        db.session.commit()
+        category_ids = [category.id for category in categories]
+
+        started = time.perf_counter()
+        for start in range(0, count, 10000):
+            insert_product_rows([
+                (
+                    ' '.join(random.sample(WORDS, 3)).title(),
+                    ' '.join(random.sample(WORDS, 8)) + f' sku{number}',
+                    round(random.uniform(500, 5000), 2),
+                    '',
+                    random.choice(category_ids)
+                )
+                for number in range(start, min(start + 10000, count))
+            ])
+            db.session.commit()
+    print(f'Created {count} products in {time.perf_counter() - started:.1f} s')
+
+
+# Function to time GET requests, optionally bypassing the catalog cache
+def time_requests(client, urls, uncached=True, headers=None):
+    timings = []
+    for url in urls:
+        if uncached:
+            catalog_cache.invalidate()
+        started = time.perf_counter()
+        response = client.get(url, headers=headers)
+        timings.append(time.perf_counter() - started)
+        assert response.status_code == 200, (url, response.status_code, response.get_data(as_text=True)[:200])
+    return timings
+
+
+# Function to create `count` customers sharing one password. Returns their
+# (username, access token) pairs.
+def create_customers(count, password='benchmark-password'):
+    hashed_password = password_hasher.hash(password)
+    with app.app_context():
+        users = [
+            User(username=f'customer{number}', email=f'customer{number}@example.com',
+                 password=hashed_password, role='customer')
+            for number in range(count)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+        return [
+            (user.username, create_access_token(identity={'id': user.id, 'role': user.role}))
+            for user in users
+        ]
+
+
+# Function to call `request(client, worker)` from each worker thread, each with
+# its own test client, until `seconds` have passed. Returns the timings and the
+# response status counts of every worker, keyed by the worker's group name.
+def run_threads(workers, seconds):
+    timings = {group: [] for group, _ in workers}
+    statuses = {group: Counter() for group, _ in workers}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def work(number, group, request):
+        client = app.test_client()
+        own_timings, own_statuses = [], Counter()
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = request(client, number)
+            own_timings.append(time.perf_counter() - started)
+            own_statuses[response.status_code] += 1
+        with lock:
+            timings[group].extend(own_timings)
+            statuses[group].update(own_statuses)
+
+    threads = [
+        threading.Thread(target=work, args=(number, group, request))
+        for number, (group, request) in enumerate(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, statuses
+
+
+# Function to run `function` and return its result and the SQL statements it ran
+def count_statements(function):
+    statements = []
+    with app.app_context():
+        engine = db.engine
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        result = function()
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    return result, statements
+
+
+# Function to list products the way GET /products did before it was paged:
+# every product at once, each loading its category lazily
+def list_all_products():
+    with app.test_request_context('/products'):
+        products = Product.query.all()
+        product_list = [{
+            'id': product.id,
+            'name': product.name,
+            'description': product.description,
+            'price': product.price,
+            'image_url': product.image_url,
+            'category': product.category.name
+        } for product in products]
+        response = jsonify(product_list)
+        db.session.remove()
+        return response
+
+
+# Keyset pages of GET /products at random cursors, uncached, against the
+# unpaged listing it replaced: latency and SQL statements per request for both
+@benchmark('products', products=100000, requests=500, limit=50, baseline_requests=5)
+def products_benchmark(options):
+    create_catalog(options.products)
+    client = app.test_client()
+
+    urls = [
+        f'/products?limit={options.limit}&after={random.randint(0, options.products)}'
+        for _ in range(options.requests)
+    ]
+    print('Keyset page of GET /products:', summary(time_requests(client, urls)))
+    _, statements = count_statements(lambda: time_requests(client, urls[:1]))
+    print(f'  SQL statements per request: {len(statements)}')
+
+    timings = []
+    for _ in range(options.baseline_requests):
+        started = time.perf_counter()
+        list_all_products()
+        timings.append(time.perf_counter() - started)
+    print('Unpaged listing (Product.query.all()):', summary(timings))
+    _, statements = count_statements(list_all_products)
+    print(f'  SQL statements per request: {len(statements)}')
+
+
+# Full text search, uncached, for selective queries (a SKU matches one
+# product) and broad ones (common words and prefixes matching a large share of
+# the catalog, with and without a category). Fails when a p95 is over budget.
+@benchmark('search', products=500000, requests=200, limit=20, budget_ms=10.0)
+def search_benchmark(options):
+    create_catalog(options.products)
+    client = app.test_client()
+
+    def urls(query):
+        return [f'/products/search?{query()}&limit={options.limit}' for _ in range(options.requests)]
+
+    runs = {
+        'Selective search': urls(lambda: f'q=sku{random.randrange(options.products)}'),
+        'Broad search': urls(lambda: f'q={random.choice(WORDS)}'),
+        'Broad prefix search': urls(lambda: f'q={random.choice(WORDS)[:3]}+{random.choice(WORDS)[:4]}'),
+        'Broad search in a category': urls(lambda: f'q={random.choice(WORDS)}&category_id={random.randint(1, 6)}')
+    }
+    over_budget = []
+    for name, run_urls in runs.items():
+        timings = time_requests(client, run_urls)
+        print(f'{name}:', summary(timings))
+        if percentile(timings, 0.95) > options.budget_ms:
+            over_budget.append(name)
+
+    if over_budget:
+        raise SystemExit(f'p95 over the {options.budget_ms} ms budget: {", ".join(over_budget)}')
+
+
+# Writer threads adding to their carts while reader threads page
+# through the catalog. Any 5xx response is a write that failed on a database
+# lock (or a reader starved by one).
+@benchmark('concurrency', products=10000, writers=4, readers=8, seconds=10.0)
+def concurrency_benchmark(options):
+    create_catalog(options.products)
+    customers = create_customers(options.writers)
+
+    def add_to_cart(client, number):
+        return client.post('/cart', json={'product_id': random.randint(1, options.products), 'quantity': 1},
+                           headers={'Authorization': f'Bearer {customers[number][1]}'})
+
+    def list_products(client, number):
+        catalog_cache.invalidate()
+        return client.get(f'/products?limit=50&after={random.randint(0, options.products)}')
+
+    workers = [('POST /cart', add_to_cart)] * options.writers + [('GET /products', list_products)] * options.readers
+    timings, statuses = run_threads(workers, options.seconds)
+    for group in timings:
+        errors = sum(count for status, count in statuses[group].items() if status >= 500)
+        print(f'{group}: {summary(timings[group])}, '
+              f'{len(timings[group]) / options.seconds:.0f}/s, {errors} errors, statuses {dict(statuses[group])}')
+
+
+# Concurrent logins, each checking a bcrypt hash in the password
+# worker pool. 503 responses are logins turned away because the pool's queue
+# was full.
+@benchmark('login', users=50, threads=16, seconds=10.0)
+def login_benchmark(options):
+    create_schema()
+    customers = create_customers(options.users)
+    print(f'BCRYPT_LOG_ROUNDS={app.config["BCRYPT_LOG_ROUNDS"]}, '
+          f'PASSWORD_HASH_WORKERS={app.config["PASSWORD_HASH_WORKERS"]}')
+
+    def login(client, number):
+        username = customers[random.randrange(len(customers))][0]
+        return client.post('/login', json={'username': username, 'password': 'benchmark-password'})
+
+    timings, statuses = run_threads([('POST /login', login)] * options.threads, options.seconds)
+    timings, statuses = timings['POST /login'], statuses['POST /login']
+    print(f'POST /login: {summary(timings)}, {statuses[200] / options.seconds:.1f} logins/s, '
+          f'{statuses[503]} busy (503), statuses {dict(statuses)}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hot API paths against a throwaway database')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+    for name, (function, options) in BENCHMARKS.items():
+        subparser = subparsers.add_parser(name)
+        for option, default in options.items():
+            subparser.add_argument(f'--{option.replace("_", "-")}', type=type(default), default=default)
+
+    options = parser.parse_args()
+    print(f'APP_ENV={os.environ.get("APP_ENV", "development")}, database in {BENCHMARK_DIRECTORY}')
+    BENCHMARKS[options.benchmark][0](options)
+
+
+if __name__ == '__main__':
+    main()
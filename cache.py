@@ -0,0 +1,75 @@
+# Standard library imports
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+# In-process cache for catalog reads.
+# Every entry is tagged with the catalog version it was built from; the product
+# write routes call invalidate(), which bumps the version so older entries are
+# never served again. Entries also expire after a TTL, which bounds staleness
+# when the write happened in another worker process.
+# ETags are a hash of the response itself, so every worker gives the same
+# response the same ETag and a changed response always gets a new one.
+class CatalogCache:
+
+    def __init__(self, max_entries=1024, ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            version, expires_at, value = entry
+            if version != self.version or expires_at < time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            # Mark the entry as most recently used
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version=None):
+        with self._lock:
+            # Drop values built before an invalidation that happened while building them
+            if version is not None and version != self.version:
+                return
+            self._entries[key] = (self.version, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+
+            # Evict the least recently used entries once the cache is full
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def etag(data, headers=()):
+        digest = hashlib.sha1(data.encode('utf-8'))
+        for name, value in sorted(headers):
+            digest.update(f'\n{name}: {value}'.encode('utf-8'))
+        return digest.hexdigest()[:32]
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'version': self.version,
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses
+            }
@@ -0,0 +1,126 @@
+# Remote library imports
+import click
+from sqlalchemy import func, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+# Local imports
+from config import app, db
+from models import Cart, CartItem, Product
+
+
+# Each cart stores the number of items it holds and their subtotal so badges
+# and checkout summaries read one row instead of every item and product.
+# Every change to a cart's items has to update these totals in the same
+# transaction, either by adjusting them (single item changes) or by
+# recomputing them (changes that touch many carts or items at once).
+# flask reconcile-carts reports (and with --fix repairs) carts that drifted.
+
+
+# Function to build an INSERT for the database in use; both SQLite and
+# PostgreSQL support ON CONFLICT through their dialect's insert()
+def dialect_insert(model):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+# Function to get the id of a user's cart, creating the cart on first use.
+# Each user has one cart (cart.user_id is unique), so two requests racing to
+# create it end up with the same row.
+def get_or_create_cart_id(user_id):
+    cart_id = db.session.query(Cart.id).filter_by(user_id=user_id).scalar()
+    if cart_id is None:
+        db.session.execute(
+            dialect_insert(Cart)
+            .values(user_id=user_id, item_count=0, subtotal=0)
+            .on_conflict_do_nothing(index_elements=['user_id'])
+        )
+        cart_id = db.session.query(Cart.id).filter_by(user_id=user_id).scalar()
+    return cart_id
+
+
+# Function to add a quantity of a product to a cart in one statement, inserting
+# the item or increasing the quantity of the one already there. With
+# replace=True the quantity of an existing item is set instead.
+def upsert_cart_item(user_id, cart_id, product_id, quantity, replace=False):
+    statement = dialect_insert(CartItem).values(
+        user_id=user_id,
+        cart_id=cart_id,
+        product_id=product_id,
+        quantity=quantity
+    )
+    new_quantity = statement.excluded.quantity if replace else CartItem.quantity + statement.excluded.quantity
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['cart_id', 'product_id'],
+        set_={'quantity': new_quantity}
+    ))
+
+
+# Function to add to the stored totals of a cart
+def adjust_cart_totals(cart_id, quantity, amount):
+    db.session.execute(
+        update(Cart)
+        .where(Cart.id == cart_id)
+        .values(item_count=Cart.item_count + quantity, subtotal=Cart.subtotal + amount)
+    )
+
+
+# Expressions computing a cart's totals from its items
+def counted_item_count():
+    return select(func.coalesce(func.sum(CartItem.quantity), 0)).where(
+        CartItem.cart_id == Cart.id
+    ).scalar_subquery()
+
+
+def counted_subtotal():
+    return select(func.coalesce(func.sum(CartItem.quantity * Product.price), 0)).join(
+        Product, CartItem.product_id == Product.id
+    ).where(CartItem.cart_id == Cart.id).scalar_subquery()
+
+
+# Function to recompute the stored totals of the given carts from their items,
+# in one statement. cart_ids may be a list or a select of cart ids.
+def refresh_cart_totals(cart_ids):
+    db.session.execute(
+        update(Cart)
+        .where(Cart.id.in_(cart_ids))
+        .values(item_count=counted_item_count(), subtotal=counted_subtotal())
+        .execution_options(synchronize_session=False)
+    )
+
+
+# Function to recompute the totals of every cart holding a product, after its
+# price changed or it was removed from carts
+def refresh_carts_with_product(product_id):
+    refresh_cart_totals(select(CartItem.cart_id).where(CartItem.product_id == product_id))
+
+
+# Function to find carts whose stored totals differ from their items
+def drifted_carts():
+    item_count = counted_item_count()
+    subtotal = counted_subtotal()
+    return db.session.execute(
+        select(Cart.id, Cart.item_count, item_count.label('counted_item_count'),
+               Cart.subtotal, subtotal.label('counted_subtotal'))
+        .where((Cart.item_count != item_count) | (func.abs(Cart.subtotal - subtotal) >= 0.005))
+        .order_by(Cart.id)
+    ).all()
+
+
+@app.cli.command('reconcile-carts')
+@click.option('--fix', is_flag=True, help='Recompute the totals of carts that drifted')
+def reconcile_carts_command(fix):
+    # Compare stored cart totals with their items
+    drifted = drifted_carts()
+    for row in drifted:
+        click.echo(
+            f'Cart {row.id}: item_count {row.item_count} (counted {row.counted_item_count}), '
+            f'subtotal {row.subtotal:.2f} (counted {row.counted_subtotal:.2f})'
+        )
+
+    if drifted and fix:
+        refresh_cart_totals([row.id for row in drifted])
+        db.session.commit()
+        click.echo(f'Fixed {len(drifted)} carts')
+    elif not drifted:
+        click.echo('All cart totals match their items')
@@ -1,28 +1,280 @@
 # Standard library imports
+from datetime import timedelta
+from functools import wraps
+import os
+import sqlite3
 
 # Remote library imports
-from flask import Flask
+from flask import Flask, g, has_app_context
 from flask_cors import CORS
 from flask_migrate import Migrate
 from flask_restful import Api
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import MetaData
+from flask_sqlalchemy.session import Session
+from sqlalchemy import MetaData, event
+from sqlalchemy.engine import Engine, make_url
 
 # Local imports
 
 # Instantiate app, set attributes
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///app.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'your_secret_key_here'
 app.config['JWT_SECRET_KEY'] = 'your_jwt_secret_key_here'
+# Access tokens are short-lived and verified without a query; clients renew
+# them at /refresh with the longer-lived refresh token, which is rotated on use
+app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(minutes=int(os.environ.get('JWT_ACCESS_TOKEN_MINUTES', 15)))
+app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=int(os.environ.get('JWT_REFRESH_TOKEN_DAYS', 30)))
 app.json.compact = False
 
+# Environment the app runs in: development, production or test
+APP_ENV = os.environ.get('APP_ENV', 'development')
+
+# Logging: JSON lines on stdout, written from a background thread. Requests
+# slower than LOG_SLOW_REQUEST_MS are logged as warnings; with
+# LOG_SLOW_REQUESTS_ONLY only those (and server errors) are logged. Busy routes
+# can be sampled, as the fraction of their requests that are logged.
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO').upper()
+app.config['LOG_SLOW_REQUESTS_ONLY'] = os.environ.get('LOG_SLOW_REQUESTS_ONLY', '0') == '1'
+app.config['LOG_SLOW_REQUEST_MS'] = int(os.environ.get('LOG_SLOW_REQUEST_MS', 500))
+app.config['LOG_SAMPLE_RATES'] = {
+    'get_all_products': 0.1,
+    'search_products': 0.1,
+    'get_product_by_id': 0.1,
+    'get_products_by_category': 0.1,
+    'get_cart_summary': 0.1,
+    'get_image': 0.01
+}
+app.config['LOG_QUEUE_SIZE'] = 10000
+
+# SQLite settings applied to every new connection, per environment.
+# WAL lets readers carry on while a writer commits, and busy_timeout makes
+# writers from other workers wait for the lock instead of failing with
+# "database is locked".
+SQLITE_PRAGMAS = {
+    'development': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000
+    },
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 15000,
+        'mmap_size': 268435456,  # 256MB of memory-mapped reads
+        'cache_size': -65536,    # 64MB page cache per connection
+        'temp_store': 'MEMORY'
+    },
+    'test': {
+        'journal_mode': 'MEMORY',
+        'synchronous': 'OFF',
+        'busy_timeout': 5000
+    }
+}
+app.config['SQLITE_PRAGMAS'] = SQLITE_PRAGMAS[APP_ENV]
+
+# Database connections come from the environment so the same code runs against
+# SQLite locally and PostgreSQL in production. DATABASE_REPLICA_URL is optional;
+# when set, the read-only routes marked with @use_replica query it instead.
+database_url = os.environ.get('DATABASE_URL', 'sqlite:///app.db')
+if database_url.startswith('postgres://'):
+    database_url = database_url.replace('postgres://', 'postgresql://', 1)
+app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+
+if os.environ.get('DATABASE_REPLICA_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {'replica': os.environ['DATABASE_REPLICA_URL']}
+
+# Connection pool settings, per environment
+SQLALCHEMY_ENGINE_OPTIONS = {
+    'development': {
+        'pool_size': 5,
+        'max_overflow': 5,
+        'pool_timeout': 10,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True
+    },
+    'production': {
+        'pool_size': 10,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True
+    },
+    'test': {
+        'pool_size': 2,
+        'max_overflow': 2,
+        'pool_timeout': 5,
+        'pool_recycle': -1,
+        'pool_pre_ping': False
+    }
+}
+engine_options = dict(SQLALCHEMY_ENGINE_OPTIONS[APP_ENV])
+
+# Pool sizes can also be tuned per deployment through the environment
+for option, variable in [
+    ('pool_size', 'DB_POOL_SIZE'),
+    ('max_overflow', 'DB_MAX_OVERFLOW'),
+    ('pool_timeout', 'DB_POOL_TIMEOUT'),
+    ('pool_recycle', 'DB_POOL_RECYCLE')
+]:
+    if variable in os.environ:
+        engine_options[option] = int(os.environ[variable])
+
+# An in-memory SQLite database lives in a single connection (a StaticPool),
+# which takes none of the pool sizing options
+database = make_url(database_url)
+if database.get_backend_name() == 'sqlite' and database.database in (None, '', ':memory:'):
+    for option in ('pool_size', 'max_overflow', 'pool_timeout'):
+        engine_options.pop(option, None)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+
+# Keyset pagination limits for list endpoints (?limit=&after=)
+app.config['DEFAULT_PAGE_SIZE'] = 50
+app.config['MAX_PAGE_SIZE'] = 200
+
+# In-process catalog read cache (number of responses kept, seconds before they expire)
+app.config['CATALOG_CACHE_SIZE'] = 1024
+app.config['CATALOG_CACHE_TTL'] = 60
+# Clients may keep catalog responses but must revalidate them with their ETag
+app.config['CATALOG_CACHE_CONTROL'] = 'public, no-cache'
+
+# Rows inserted and committed together by the bulk product import
+app.config['PRODUCT_IMPORT_BATCH_SIZE'] = 5000
+
+# Product images: uploaded originals and their resized variants are stored
+# under IMAGE_STORAGE_DIR. Variants are bounded to IMAGE_CACHE_MAX_BYTES on disk
+# and served with immutable cache headers, so a variant's size must not change
+# under the same name; add a new name instead.
+app.config['IMAGE_STORAGE_DIR'] = os.environ.get('IMAGE_STORAGE_DIR', os.path.join(app.instance_path, 'images'))
+app.config['IMAGE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+app.config['IMAGE_MAX_UPLOAD_BYTES'] = 10 * 1024 * 1024
+app.config['IMAGE_VARIANTS'] = {
+    'thumbnail': (200, 200),
+    'card': (600, 600),
+    'full': (1600, 1600)
+}
+app.config['IMAGE_FORMAT'] = 'webp'  # falls back to jpg when Pillow lacks WebP support
+app.config['IMAGE_QUALITY'] = 80
+app.config['IMAGE_MAX_AGE'] = 365 * 24 * 60 * 60
+
+# Most operations accepted by one PATCH /cart request
+app.config['CART_BATCH_MAX_OPERATIONS'] = 100
+
+# Product search: results that can be paged through per query, and the length
+# from which a query word also matches longer words (shorter words match whole
+# words; see PRODUCT_FTS_PREFIXES in models.py for the longest prefix)
+app.config['SEARCH_MAX_RESULTS'] = 1000
+app.config['SEARCH_MIN_PREFIX_LENGTH'] = 2
+
+# Seconds a stored Idempotency-Key response is replayed for
+app.config['IDEMPOTENCY_KEY_TTL'] = 24 * 60 * 60
+
+# bcrypt cost factor for password hashes; existing hashes are upgraded on login
+# when it changes. Hashing runs in PASSWORD_HASH_WORKERS processes, and logins
+# beyond PASSWORD_HASH_MAX_PENDING in flight are answered with 503.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+app.config['PASSWORD_HASH_MAX_PENDING'] = 32
+app.config['PASSWORD_HASH_TIMEOUT'] = 30
+
+# Seconds a user record stays cached for routes that check the current role
+app.config['USER_CACHE_TTL'] = 30
+
+# Rate limits per route, as (requests, seconds): each user (or IP address when
+# not logged in) may burst that many requests and regains them evenly over the
+# period. Routes not listed are not limited. Buckets are kept in memory, which
+# suits a single worker; point RATE_LIMIT_STORAGE at a sqlite:/// file to share
+# them between the workers of one host.
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+app.config['RATE_LIMIT_STORAGE'] = os.environ.get('RATE_LIMIT_STORAGE', 'memory')
+app.config['RATE_LIMITS'] = {
+    'login': (10, 60),
+    'register': (5, 60),
+    'refresh': (30, 60),
+    'get_all_products': (120, 60),
+    'search_products': (60, 60),
+    'get_products_by_category': (120, 60),
+    'create_order': (10, 60),
+    'stk_push': (5, 60),
+    'get_payment_status': (60, 60)
+}
+# Verified access tokens remembered for picking a user's bucket
+app.config['RATE_LIMIT_TOKEN_CACHE_SIZE'] = 10000
+
+# M-Pesa (Daraja) credentials, overridable from the environment
+app.config['MPESA_BASE_URL'] = os.environ.get('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke')
+app.config['MPESA_CONSUMER_KEY'] = os.environ.get('MPESA_CONSUMER_KEY', 'EGUWDv8KcAgJQe08Gbgd0XDiJrmANJ7qV0SWwkxuh0aaGhnC')
+app.config['MPESA_CONSUMER_SECRET'] = os.environ.get('MPESA_CONSUMER_SECRET', 'fXBG6h3MayGHakAnj0bc3FGosRquGcoGEazg3JwfjmRe9SzB1YwuqTWwliOVNpFq')
+app.config['MPESA_SHORTCODE'] = os.environ.get('MPESA_SHORTCODE', '174379')
+app.config['MPESA_PASSKEY'] = os.environ.get('MPESA_PASSKEY', 'bfb279f9aa9bdbcf158e97dd71a467cd2e0c893059b10f78e6b72ada1ed2c919')
+# Seconds before expiry at which the cached OAuth token is refreshed
+app.config['MPESA_TOKEN_REFRESH_MARGIN'] = 60
+# Public url Safaricom posts STK push results to, and the secret it must carry as
+# ?token= (include it in MPESA_CALLBACK_URL). Outside development callbacks are
+# refused until a token is configured.
+app.config['MPESA_CALLBACK_URL'] = os.environ.get('MPESA_CALLBACK_URL', 'https://example.com/mpesa/callback')
+app.config['MPESA_CALLBACK_TOKEN'] = os.environ.get('MPESA_CALLBACK_TOKEN')
+app.config['MPESA_CALLBACK_TOKEN_REQUIRED'] = APP_ENV != 'development'
+
+# Background job queue: default attempts before a job is dead-lettered, seconds
+# a claimed job stays invisible to other workers, base seconds of the
+# exponential retry backoff, and seconds an idle worker waits between polls
+app.config['JOB_MAX_ATTEMPTS'] = 5
+app.config['JOB_VISIBILITY_TIMEOUT'] = 300
+app.config['JOB_RETRY_BACKOFF'] = 10
+app.config['JOB_POLL_INTERVAL'] = 1
+
+# Outbound HTTP calls to payment providers: pooled connections per host,
+# (connect, read) timeouts in seconds, retries with backoff, and a circuit
+# breaker that opens after consecutive failures for the given seconds
+app.config['OUTBOUND_POOL_SIZE'] = 10
+app.config['OUTBOUND_CONNECT_TIMEOUT'] = 3.05
+app.config['OUTBOUND_READ_TIMEOUT'] = 10
+app.config['OUTBOUND_MAX_RETRIES'] = 2
+app.config['OUTBOUND_BACKOFF'] = 0.5
+app.config['OUTBOUND_CIRCUIT_FAILURES'] = 5
+app.config['OUTBOUND_CIRCUIT_RESET'] = 30
+
 # Define metadata, instantiate db
 metadata = MetaData(naming_convention={
+    "ix": "ix_%(column_0_label)s",
     "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
 })
-db = SQLAlchemy(metadata=metadata)
+
+# Session that sends queries to the read replica while a @use_replica view runs.
+# Flushes always go to the primary.
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and has_app_context()
+            and g.get('use_replica')
+            and 'replica' in self._db.engines
+        ):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+# Decorator for read-only views whose queries may be served by the replica
+def use_replica(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+db = SQLAlchemy(metadata=metadata, session_options={'class_': RoutingSession})
+
+# Apply the configured pragmas to every SQLite connection the pool opens
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+    cursor.close()
+
 migrate = Migrate(app, db)
 db.init_app(app)
 
@@ -0,0 +1,191 @@
+# Standard library imports
+from collections import defaultdict, deque
+import random
+import threading
+import time
+
+# Remote library imports
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+# Local imports
+from config import app
+
+
+# Raised instead of calling a provider whose circuit breaker is open
+class CircuitOpenError(Exception):
+    pass
+
+
+# Function to tell whether a failed call never reached the provider: the
+# circuit was open or no connection could be made, so nothing was sent and the
+# request can be resent whatever its method. Any other transport error may
+# have happened after the provider received the request.
+def request_not_sent(error):
+    if isinstance(error, (CircuitOpenError, requests.ConnectTimeout)):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    # requests wraps urllib3's MaxRetryError, whose reason is the actual failure
+    reason = getattr(error.args[0], 'reason', error.args[0])
+    return isinstance(reason, NewConnectionError)
+
+
+# Circuit breaker for one outbound endpoint.
+# After failure_threshold consecutive failed calls the circuit opens and calls
+# fail immediately for reset_timeout seconds; then a single trial call is let
+# through and its outcome closes or re-opens the circuit.
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half_open'
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+# Call counts and recent latencies for one outbound endpoint
+class EndpointMetrics:
+
+    def __init__(self, window=500):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, latency, error=False):
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            requests_made, errors, retries, rejected = self.requests, self.errors, self.retries, self.rejected
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            return round(latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000, 1)
+
+        return {
+            'requests': requests_made,
+            'errors': errors,
+            'retries': retries,
+            'rejected_by_circuit': rejected,
+            'p50_ms': percentile(0.50),
+            'p95_ms': percentile(0.95)
+        }
+
+
+# Shared HTTP client for calls to third-party providers.
+# One pooled keep-alive session is reused for every call, every request has a
+# connect and read timeout, failures are retried a bounded number of times with
+# jittered exponential backoff, and each named endpoint has its own circuit
+# breaker and metrics.
+class OutboundClient:
+
+    # Methods that are safe to resend after the request may have reached the provider
+    IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+    RETRY_STATUSES = {429, 502, 503, 504}
+
+    def __init__(self, pool_size=10, connect_timeout=3.05, read_timeout=10,
+                 max_retries=2, backoff=0.5, failure_threshold=5, reset_timeout=30):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._breakers = defaultdict(lambda: CircuitBreaker(failure_threshold, reset_timeout))
+        self._metrics = defaultdict(EndpointMetrics)
+
+    def request(self, endpoint, method, url, **kwargs):
+        breaker = self._breakers[endpoint]
+        metrics = self._metrics[endpoint]
+        if not breaker.allow():
+            metrics.rejected += 1
+            raise CircuitOpenError(f'{endpoint} is unavailable')
+
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        idempotent = method.upper() in self.IDEMPOTENT_METHODS
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            started = time.perf_counter()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as error:
+                metrics.record(time.perf_counter() - started, error=True)
+                # A request that never connected can always be resent; anything
+                # else is only resent for idempotent methods
+                if last_attempt or not (idempotent or request_not_sent(error)):
+                    breaker.record_failure()
+                    raise
+            else:
+                failed = response.status_code >= 500
+                metrics.record(time.perf_counter() - started, error=failed)
+                if last_attempt or not (idempotent and response.status_code in self.RETRY_STATUSES):
+                    if failed:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    return response
+
+            metrics.retries += 1
+            time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def get(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'GET', url, **kwargs)
+
+    def post(self, endpoint, url, **kwargs):
+        return self.request(endpoint, 'POST', url, **kwargs)
+
+    def metrics(self):
+        return {
+            endpoint: {**metrics.snapshot(), 'circuit': self._breakers[endpoint].state}
+            for endpoint, metrics in list(self._metrics.items())
+        }
+
+
+outbound = OutboundClient(
+    pool_size=app.config['OUTBOUND_POOL_SIZE'],
+    connect_timeout=app.config['OUTBOUND_CONNECT_TIMEOUT'],
+    read_timeout=app.config['OUTBOUND_READ_TIMEOUT'],
+    max_retries=app.config['OUTBOUND_MAX_RETRIES'],
+    backoff=app.config['OUTBOUND_BACKOFF'],
+    failure_threshold=app.config['OUTBOUND_CIRCUIT_FAILURES'],
+    reset_timeout=app.config['OUTBOUND_CIRCUIT_RESET']
+)
@@ -0,0 +1,112 @@
+# Standard library imports
+from datetime import datetime, timedelta
+from functools import wraps
+import hashlib
+import json
+
+# Remote library imports
+from flask import current_app, jsonify, make_response, request
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy.exc import IntegrityError
+
+# Local imports
+from config import db
+from models import IdempotencyKey
+
+# Response headers stored with the response and sent again on replay
+REPLAYED_HEADERS = ('Content-Type', 'Location', 'Retry-After')
+
+
+# Function to work out who a request belongs to, if anyone is logged in
+def request_owner():
+    try:
+        identity = get_jwt_identity()
+    except RuntimeError:
+        # The view is not protected with @jwt_required()
+        return ''
+    if isinstance(identity, dict):
+        return str(identity.get('id', ''))
+    return str(identity or '')
+
+
+# Decorator that honours the Idempotency-Key header on a write route.
+# The first request with a key runs the view and stores its response; retries
+# with the same key and body get that response back without running the view
+# again, so a client retrying after a timeout cannot create a second order or
+# send a second payment prompt. Place it below @jwt_required() so keys are
+# scoped to the logged-in user.
+def idempotent(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'message': 'Idempotency-Key is too long'}), 400
+
+        scope = f'{request.method} {request.path} {request_owner()}'.strip()
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        now = datetime.utcnow()
+
+        record = IdempotencyKey.query.filter_by(key=key, scope=scope).first()
+        if record and record.expires_at <= now:
+            db.session.delete(record)
+            db.session.commit()
+            record = None
+
+        if record:
+            if record.fingerprint != fingerprint:
+                return jsonify({'message': 'Idempotency-Key was already used for a different request'}), 422
+            if record.status_code is None:
+                return jsonify({'message': 'A request with this Idempotency-Key is still being processed'}), 409
+
+            # Replay the stored response
+            response = current_app.response_class(
+                record.response_body,
+                status=record.status_code,
+                mimetype='application/json'
+            )
+            response.headers.update(json.loads(record.response_headers or '{}'))
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        # Reserve the key before running the view so a concurrent retry is turned away.
+        # Expired keys are cleared out at the same time.
+        IdempotencyKey.query.filter(IdempotencyKey.expires_at < now).delete(synchronize_session=False)
+        db.session.add(IdempotencyKey(
+            key=key,
+            scope=scope,
+            fingerprint=fingerprint,
+            expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_KEY_TTL'])
+        ))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'message': 'A request with this Idempotency-Key is still being processed'}), 409
+
+        reserved = IdempotencyKey.query.filter_by(key=key, scope=scope)
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            # Release the key so the client can retry
+            db.session.rollback()
+            reserved.delete(synchronize_session=False)
+            db.session.commit()
+            raise
+
+        if response.status_code >= 500:
+            # Server errors are not stored, the retry should run the view again
+            reserved.delete(synchronize_session=False)
+        else:
+            reserved.update({
+                'status_code': response.status_code,
+                'response_body': response.get_data(as_text=True),
+                'response_headers': json.dumps({
+                    name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers
+                })
+            }, synchronize_session=False)
+        db.session.commit()
+
+        return response
+    return wrapper
@@ -0,0 +1,216 @@
+# Standard library imports
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+import uuid
+
+# Remote library imports
+import click
+
+# Pillow is optional: without it images that are already processed are still
+# served, but uploads and new variants are refused
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+# Local imports
+from config import app, db
+from jobs import job
+from models import Product
+
+# Matches the urls this module hands out, /images/<sha256 of the original>/<variant>.<ext>
+IMAGE_URL_PATTERN = re.compile(r'^/images/([0-9a-f]{64})/(\w+)\.(webp|jpg)$')
+
+
+# Raised when an image can not be processed
+class ImageError(Exception):
+    pass
+
+
+# Raised when Pillow is not installed
+class ImageSupportMissing(ImageError):
+    pass
+
+
+# Function to get the file extension variants are encoded with
+def variant_extension():
+    if app.config['IMAGE_FORMAT'] == 'webp' and Image is not None and features.check('webp'):
+        return 'webp'
+    return 'jpg'
+
+
+# Function to build the url of a variant of a stored image
+def image_url(digest, variant):
+    return f'/images/{digest}/{variant}.{variant_extension()}'
+
+
+# Function to get the thumbnail url for a product's image_url. Images stored
+# here get their thumbnail variant; images hosted elsewhere are left as they are.
+def thumbnail_url(url):
+    match = IMAGE_URL_PATTERN.match(url or '')
+    if not match:
+        return url
+    return image_url(match.group(1), 'thumbnail')
+
+
+# Originals are kept under originals/ by the sha256 of their bytes and never
+# evicted. Resized variants are kept under variants/ and can always be rebuilt
+# from the original, so that directory is bounded to max_bytes by deleting the
+# least recently served files.
+class ImageStore:
+
+    def __init__(self, directory, max_bytes):
+        self.originals = os.path.join(directory, 'originals')
+        self.variants = os.path.join(directory, 'variants')
+        self.max_bytes = max_bytes
+        self._variant_bytes = None
+        self._lock = threading.Lock()
+
+    def original_path(self, digest):
+        return os.path.join(self.originals, digest)
+
+    def variant_path(self, digest, variant, extension):
+        return os.path.join(self.variants, f'{digest}-{variant}.{extension}')
+
+    # Stores the original image and returns its digest
+    def save_original(self, data):
+        if Image is None:
+            raise ImageSupportMissing('Image processing is not available')
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image.verify()
+        except Exception as error:
+            raise ImageError(f'Not a supported image: {error}')
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.original_path(digest)
+        if not os.path.exists(path):
+            self._write(path, data)
+        return digest
+
+    # Returns the path of a variant, creating it from the original when needed
+    def get_variant(self, digest, variant, extension):
+        path = self.variant_path(digest, variant, extension)
+        try:
+            # Serving a variant marks it as recently used for eviction. Only the
+            # access time is set; the modification time is part of the ETag.
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+            return path
+        except FileNotFoundError:
+            pass
+
+        if not os.path.exists(self.original_path(digest)):
+            return None
+        data = self._render(digest, variant, extension)
+        self._write(path, data)
+        self._add_variant_bytes(len(data))
+        return path
+
+    def _render(self, digest, variant, extension):
+        if Image is None or (extension == 'webp' and not features.check('webp')):
+            raise ImageSupportMissing('Image processing is not available')
+        box = app.config['IMAGE_VARIANTS'][variant]
+
+        with Image.open(self.original_path(digest)) as image:
+            # Let the JPEG decoder scale down while decoding
+            image.draft('RGB', box)
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail(box, Image.LANCZOS)
+
+            output = io.BytesIO()
+            if extension == 'webp':
+                image.save(output, 'WEBP', quality=app.config['IMAGE_QUALITY'], method=4)
+            else:
+                image.convert('RGB').save(
+                    output, 'JPEG', quality=app.config['IMAGE_QUALITY'], optimize=True, progressive=True
+                )
+        return output.getvalue()
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name first so a reader never sees a partial file
+        temporary_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+    def _variant_files(self):
+        try:
+            entries = list(os.scandir(self.variants))
+        except FileNotFoundError:
+            return []
+        return [entry for entry in entries if entry.is_file() and not entry.name.endswith('.tmp')]
+
+    def _add_variant_bytes(self, size):
+        with self._lock:
+            if self._variant_bytes is None:
+                self._variant_bytes = sum(entry.stat().st_size for entry in self._variant_files())
+            else:
+                self._variant_bytes += size
+            if self._variant_bytes > self.max_bytes:
+                self._evict()
+
+    # Deletes the least recently served variants until the cache is at 90% of its limit
+    def _evict(self):
+        files = sorted(
+            ((entry.stat().st_atime, entry.stat().st_size, entry.path) for entry in self._variant_files())
+        )
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._variant_bytes = total
+
+
+image_store = ImageStore(app.config['IMAGE_STORAGE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+
+
+# Job to render every variant of a newly stored image ahead of the first request
+@job(max_attempts=3)
+def generate_image_variants(digest):
+    for variant in app.config['IMAGE_VARIANTS']:
+        image_store.get_variant(digest, variant, variant_extension())
+
+
+# Function to store an image and point a product at it. Returns the urls of its variants.
+def attach_product_image(product, data):
+    digest = image_store.save_original(data)
+    product.image_url = image_url(digest, 'full')
+    generate_image_variants.delay(digest)
+    return {variant: image_url(digest, variant) for variant in app.config['IMAGE_VARIANTS']}
+
+
+@app.cli.command('ingest-images')
+@click.argument('paths', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--product-id', type=int, help='Product to attach the image to (one path only)')
+def ingest_images_command(paths, product_id):
+    # Store local image files and render their variants
+    if product_id is not None and len(paths) != 1:
+        raise click.UsageError('--product-id takes exactly one image path')
+
+    for path in paths:
+        with open(path, 'rb') as file:
+            data = file.read()
+        try:
+            digest = image_store.save_original(data)
+            generate_image_variants(digest)
+        except ImageError as error:
+            raise click.ClickException(f'{path}: {error}')
+
+        if product_id is not None:
+            product = db.session.get(Product, product_id)
+            if not product:
+                raise click.ClickException(f'Product {product_id} not found')
+            product.image_url = image_url(digest, 'full')
+            db.session.commit()
+
+        click.echo(f'{path} -> {image_url(digest, "full")}')
@@ -0,0 +1,156 @@
+# Standard library imports
+from datetime import datetime, timedelta
+import json
+import time
+import traceback
+
+# Remote library imports
+from sqlalchemy import and_, func, or_, update
+
+# Local imports
+from config import app, db
+from models import Job
+
+
+# Durable background job queue stored in the job table.
+#
+# A function decorated with @job() gets a .delay(*args, **kwargs) method that
+# records a job row instead of running it; routes call .delay() so slow side
+# effects happen outside the request. Start one or more workers with
+#
+#     flask --app app run-worker
+#
+# A worker claims a job by setting its visibility timeout (locked_until); if
+# the worker dies, the job becomes claimable again once the timeout passes.
+# Failed jobs are retried with exponential backoff and, after max_attempts,
+# left in the 'dead' status (the dead-letter list) with their last error.
+
+registry = {}
+
+
+def job(max_attempts=None, on_dead=None):
+    def decorator(function):
+        name = f'{function.__module__}.{function.__name__}'
+        registry[name] = (function, on_dead)
+
+        def delay(*args, **kwargs):
+            return enqueue(name, args, kwargs, max_attempts=max_attempts)
+
+        function.delay = delay
+        return function
+    return decorator
+
+
+# Function to add a job to the session. It is committed together with whatever
+# the caller commits next, so the job only exists if the caller's own writes do.
+def enqueue(name, args=(), kwargs=None, max_attempts=None, run_at=None):
+    new_job = Job(
+        name=name,
+        payload=json.dumps({'args': list(args), 'kwargs': kwargs or {}}),
+        max_attempts=max_attempts or app.config['JOB_MAX_ATTEMPTS'],
+        run_at=run_at or datetime.utcnow()
+    )
+    db.session.add(new_job)
+    return new_job
+
+
+# Function to claim the next runnable job for this worker, or return None
+def claim_job():
+    while True:
+        now = datetime.utcnow()
+        runnable = or_(
+            and_(Job.status == 'queued', Job.run_at <= now),
+            and_(Job.status == 'running', Job.locked_until < now)
+        )
+        job_id = db.session.query(Job.id).filter(runnable).order_by(Job.run_at, Job.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+
+        # Only one worker wins the conditional update; the others look again
+        claimed = db.session.execute(
+            update(Job)
+            .where(Job.id == job_id)
+            .where(runnable)
+            .values(
+                status='running',
+                attempts=Job.attempts + 1,
+                locked_until=now + timedelta(seconds=app.config['JOB_VISIBILITY_TIMEOUT'])
+            )
+        ).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+
+
+# Function to run a claimed job and record the outcome
+def run_job(claimed_job):
+    function, on_dead = registry.get(claimed_job.name, (None, None))
+    payload = json.loads(claimed_job.payload)
+
+    try:
+        if function is None:
+            raise LookupError(f'No job function registered as {claimed_job.name}')
+        function(*payload['args'], **payload['kwargs'])
+    except Exception:
+        db.session.rollback()
+        claimed_job.last_error = traceback.format_exc()[-4000:]
+        claimed_job.locked_until = None
+        app.logger.warning('Job failed', exc_info=True, extra={
+            'job_id': claimed_job.id, 'job': claimed_job.name, 'attempts': claimed_job.attempts
+        })
+        if claimed_job.attempts >= claimed_job.max_attempts:
+            claimed_job.status = 'dead'
+            claimed_job.finished_at = datetime.utcnow()
+            db.session.commit()
+            if on_dead is not None:
+                on_dead(*payload['args'], **payload['kwargs'])
+        else:
+            backoff = app.config['JOB_RETRY_BACKOFF'] * (2 ** (claimed_job.attempts - 1))
+            claimed_job.status = 'queued'
+            claimed_job.run_at = datetime.utcnow() + timedelta(seconds=backoff)
+            db.session.commit()
+        return False
+
+    claimed_job.status = 'done'
+    claimed_job.locked_until = None
+    claimed_job.finished_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+# Function to process jobs until stopped (or until the queue is empty with once=True).
+# Errors outside the job function itself (a failing on_dead handler, a commit
+# refused because the database is locked) are logged and the worker carries on;
+# the job is picked up again once its visibility timeout passes.
+def run_worker(once=False):
+    with app.app_context():
+        while True:
+            try:
+                claimed_job = claim_job()
+                if claimed_job is None:
+                    if once:
+                        return
+                    time.sleep(app.config['JOB_POLL_INTERVAL'])
+                    continue
+                run_job(claimed_job)
+            except Exception:
+                app.logger.exception('Job worker error')
+                db.session.rollback()
+                if once:
+                    return
+                time.sleep(app.config['JOB_POLL_INTERVAL'])
+            finally:
+                db.session.remove()
+
+
+# Function to count jobs per status, for the metrics route
+def job_counts():
+    rows = db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all()
+    return {status: count for status, count in rows}
+
+
+@app.cli.command('run-worker')
+def run_worker_command():
+    # Process background jobs until interrupted
+    run_worker()
@@ -0,0 +1,34 @@
+"""add revoked token
+
+Revision ID: 2c8d6b4f1a93
+Revises: 7a3e5f0b2c19
+Create Date: 2026-10-18 13:22:40.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2c8d6b4f1a93'
+down_revision = '7a3e5f0b2c19'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('revoked_token',
+    sa.Column('jti', sa.String(length=36), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('jti')
+    )
+    with op.batch_alter_table('revoked_token', schema=None) as batch_op:
+        batch_op.create_index('ix_revoked_token_expires_at', ['expires_at'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('revoked_token', schema=None) as batch_op:
+        batch_op.drop_index('ix_revoked_token_expires_at')
+
+    op.drop_table('revoked_token')
@@ -0,0 +1,57 @@
+"""product full text search
+
+Revision ID: 3f9c2a7d5e81
+Revises: 100ff208cae7
+Create Date: 2026-10-18 09:12:40.118203
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d5e81'
+down_revision = '100ff208cae7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # FTS5 is SQLite only; on other databases product search answers 501
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    # FTS5 external-content table over product(name, description), kept in sync by triggers
+    op.execute(
+        "CREATE VIRTUAL TABLE product_fts USING fts5("
+        "name, description, content='product', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    op.execute(
+        "CREATE TRIGGER product_fts_ai AFTER INSERT ON product BEGIN "
+        "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER product_fts_ad AFTER DELETE ON product BEGIN "
+        "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+        "END"
+    )
+    op.execute(
+        "CREATE TRIGGER product_fts_au AFTER UPDATE OF name, description ON product BEGIN "
+        "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+        "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); "
+        "END"
+    )
+    # Index the products that already exist
+    op.execute("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    op.execute('DROP TRIGGER IF EXISTS product_fts_au')
+    op.execute('DROP TRIGGER IF EXISTS product_fts_ad')
+    op.execute('DROP TRIGGER IF EXISTS product_fts_ai')
+    op.execute('DROP TABLE IF EXISTS product_fts')
@@ -0,0 +1,73 @@
+"""merge duplicate carts
+
+Revision ID: 4b7e0d3a6f21
+Revises: 9f4a2e7c1b36
+Create Date: 2026-10-18 14:41:27.190455
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e0d3a6f21'
+down_revision = '9f4a2e7c1b36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # add_to_cart used to create a new cart on every call. Each user keeps their
+    # oldest cart; items of the same product are merged into one row.
+    op.execute(
+        'UPDATE cart_item SET quantity = ('
+        'SELECT SUM(other.quantity) FROM cart_item AS other '
+        'WHERE other.user_id = cart_item.user_id AND other.product_id = cart_item.product_id'
+        ') WHERE id IN ('
+        'SELECT MIN(id) FROM cart_item GROUP BY user_id, product_id HAVING COUNT(*) > 1'
+        ')'
+    )
+    op.execute(
+        'DELETE FROM cart_item WHERE id NOT IN ('
+        'SELECT MIN(id) FROM cart_item GROUP BY user_id, product_id'
+        ')'
+    )
+
+    # Move the remaining items, and orders placed from a duplicate, to the kept cart
+    op.execute(
+        'UPDATE cart_item SET cart_id = COALESCE(('
+        'SELECT MIN(cart.id) FROM cart WHERE cart.user_id = cart_item.user_id'
+        '), cart_id)'
+    )
+    op.execute(
+        'UPDATE "order" SET cart_id = ('
+        'SELECT MIN(cart.id) FROM cart WHERE cart.user_id = "order".user_id'
+        ') WHERE cart_id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id) '
+        'AND user_id IN (SELECT user_id FROM cart)'
+    )
+    op.execute('DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id)')
+
+    # Recompute the totals of the merged carts
+    op.execute('''
+        UPDATE cart SET
+            item_count = (
+                SELECT COALESCE(SUM(cart_item.quantity), 0)
+                FROM cart_item WHERE cart_item.cart_id = cart.id
+            ),
+            subtotal = (
+                SELECT COALESCE(SUM(cart_item.quantity * product.price), 0)
+                FROM cart_item JOIN product ON product.id = cart_item.product_id
+                WHERE cart_item.cart_id = cart.id
+            )
+    ''')
+
+    with op.batch_alter_table('cart', schema=None) as batch_op:
+        batch_op.drop_index('ix_cart_user_id')
+        batch_op.create_index('ix_cart_user_id', ['user_id'], unique=True)
+
+
+def downgrade():
+    # Merged carts are not split again
+    with op.batch_alter_table('cart', schema=None) as batch_op:
+        batch_op.drop_index('ix_cart_user_id')
+        batch_op.create_index('ix_cart_user_id', ['user_id'], unique=False)
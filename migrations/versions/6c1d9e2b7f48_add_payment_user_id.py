@@ -0,0 +1,37 @@
+"""add payment user id
+
+Revision ID: 6c1d9e2b7f48
+Revises: 4b7e0d3a6f21
+Create Date: 2026-10-18 16:12:40.518927
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6c1d9e2b7f48'
+down_revision = '4b7e0d3a6f21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('payment', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('user_id', sa.Integer(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_payment_user_id'), ['user_id'], unique=False)
+        batch_op.create_foreign_key(batch_op.f('fk_payment_user_id_user'), 'user', ['user_id'], ['id'])
+
+    # Payments made so far belong to the user who placed their order
+    op.execute(
+        'UPDATE payment SET user_id = ('
+        'SELECT "order".user_id FROM "order" WHERE "order".id = payment.order_id'
+        ')'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('payment', schema=None) as batch_op:
+        batch_op.drop_constraint(batch_op.f('fk_payment_user_id_user'), type_='foreignkey')
+        batch_op.drop_index(batch_op.f('ix_payment_user_id'))
+        batch_op.drop_column('user_id')
@@ -0,0 +1,31 @@
+"""add order created_at
+
+Revision ID: 8b1e4d6c2f07
+Revises: 3f9c2a7d5e81
+Create Date: 2026-10-18 10:03:27.540611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e4d6c2f07'
+down_revision = '3f9c2a7d5e81'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('order', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('created_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_order_created_at'), ['created_at'], unique=False)
+
+    # Existing orders have no recorded date, stamp them with the migration time
+    op.execute('UPDATE "order" SET created_at = CURRENT_TIMESTAMP WHERE created_at IS NULL')
+
+
+def downgrade():
+    with op.batch_alter_table('order', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_order_created_at'))
+        batch_op.drop_column('created_at')
@@ -0,0 +1,42 @@
+"""add cart totals
+
+Revision ID: 9f4a2e7c1b36
+Revises: 2c8d6b4f1a93
+Create Date: 2026-10-18 14:05:12.733190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f4a2e7c1b36'
+down_revision = '2c8d6b4f1a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('cart', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('item_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('subtotal', sa.Float(), server_default='0', nullable=False))
+
+    # Fill in the totals of existing carts
+    op.execute('''
+        UPDATE cart SET
+            item_count = (
+                SELECT COALESCE(SUM(cart_item.quantity), 0)
+                FROM cart_item WHERE cart_item.cart_id = cart.id
+            ),
+            subtotal = (
+                SELECT COALESCE(SUM(cart_item.quantity * product.price), 0)
+                FROM cart_item JOIN product ON product.id = cart_item.product_id
+                WHERE cart_item.cart_id = cart.id
+            )
+    ''')
+
+
+def downgrade():
+    with op.batch_alter_table('cart', schema=None) as batch_op:
+        batch_op.drop_column('subtotal')
+        batch_op.drop_column('item_count')
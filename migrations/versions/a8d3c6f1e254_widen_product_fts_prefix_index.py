@@ -0,0 +1,39 @@
+"""widen product fts prefix index
+
+Revision ID: a8d3c6f1e254
+Revises: 6c1d9e2b7f48
+Create Date: 2026-10-18 18:40:12.604117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d3c6f1e254'
+down_revision = '6c1d9e2b7f48'
+branch_labels = None
+depends_on = None
+
+
+# Function to rebuild product_fts with a prefix index for the given lengths.
+# The triggers refer to the table by name and keep working once it is back.
+def recreate_product_fts(prefixes):
+    op.execute('DROP TABLE IF EXISTS product_fts')
+    op.execute(
+        "CREATE VIRTUAL TABLE product_fts USING fts5("
+        "name, description, content='product', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2', prefix='{prefixes}')"
+    )
+    op.execute("INSERT INTO product_fts(product_fts) VALUES ('rebuild')")
+
+
+def upgrade():
+    # product_fts only exists on SQLite
+    if op.get_bind().dialect.name == 'sqlite':
+        recreate_product_fts('2 3 4 5 6')
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        recreate_product_fts('2 3')
@@ -0,0 +1,55 @@
+"""add foreign key indexes
+
+Revision ID: c47a0e95b3d2
+Revises: 8b1e4d6c2f07
+Create Date: 2026-10-18 10:41:52.206734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a0e95b3d2'
+down_revision = '8b1e4d6c2f07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Merge duplicate (cart_id, product_id) rows into the oldest one so the unique index can be built
+    op.execute(
+        'UPDATE cart_item SET quantity = ('
+        'SELECT SUM(duplicate.quantity) FROM cart_item AS duplicate '
+        'WHERE duplicate.cart_id = cart_item.cart_id AND duplicate.product_id = cart_item.product_id'
+        ') WHERE id IN ('
+        'SELECT MIN(id) FROM cart_item GROUP BY cart_id, product_id HAVING COUNT(*) > 1'
+        ')'
+    )
+    op.execute(
+        'DELETE FROM cart_item WHERE id NOT IN ('
+        'SELECT MIN(id) FROM cart_item GROUP BY cart_id, product_id'
+        ')'
+    )
+
+    op.create_index('ix_product_category_id_id', 'product', ['category_id', 'id'], unique=False)
+    op.create_index('ix_cart_user_id', 'cart', ['user_id'], unique=False)
+    op.create_index('ix_cart_item_cart_id_product_id', 'cart_item', ['cart_id', 'product_id'], unique=True)
+    op.create_index('ix_cart_item_user_id_product_id', 'cart_item', ['user_id', 'product_id'], unique=False)
+    op.create_index('ix_cart_item_product_id', 'cart_item', ['product_id'], unique=False)
+    op.create_index('ix_order_user_id_id', 'order', ['user_id', 'id'], unique=False)
+    op.create_index('ix_order_status_id', 'order', ['status', 'id'], unique=False)
+    op.create_index('ix_order_item_order_id', 'order_item', ['order_id'], unique=False)
+    op.create_index('ix_order_item_product_id', 'order_item', ['product_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_order_item_product_id', table_name='order_item')
+    op.drop_index('ix_order_item_order_id', table_name='order_item')
+    op.drop_index('ix_order_status_id', table_name='order')
+    op.drop_index('ix_order_user_id_id', table_name='order')
+    op.drop_index('ix_cart_item_product_id', table_name='cart_item')
+    op.drop_index('ix_cart_item_user_id_product_id', table_name='cart_item')
+    op.drop_index('ix_cart_item_cart_id_product_id', table_name='cart_item')
+    op.drop_index('ix_cart_user_id', table_name='cart')
+    op.drop_index('ix_product_category_id_id', table_name='product')
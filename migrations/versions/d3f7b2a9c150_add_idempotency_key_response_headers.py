@@ -0,0 +1,26 @@
+"""add idempotency key response headers
+
+Revision ID: d3f7b2a9c150
+Revises: a8d3c6f1e254
+Create Date: 2026-10-18 19:25:51.207384
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f7b2a9c150'
+down_revision = 'a8d3c6f1e254'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('idempotency_key', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('response_headers', sa.Text(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('idempotency_key', schema=None) as batch_op:
+        batch_op.drop_column('response_headers')
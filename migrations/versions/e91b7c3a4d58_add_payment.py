@@ -0,0 +1,45 @@
+"""add payment
+
+Revision ID: e91b7c3a4d58
+Revises: 5d2f8a1c9e64
+Create Date: 2026-10-18 12:02:51.694027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e91b7c3a4d58'
+down_revision = '5d2f8a1c9e64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('payment',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('order_id', sa.Integer(), nullable=True),
+    sa.Column('phone_number', sa.String(length=20), nullable=False),
+    sa.Column('amount', sa.Float(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('merchant_request_id', sa.String(length=100), nullable=True),
+    sa.Column('checkout_request_id', sa.String(length=100), nullable=True),
+    sa.Column('result_code', sa.Integer(), nullable=True),
+    sa.Column('result_description', sa.String(length=255), nullable=True),
+    sa.Column('mpesa_receipt', sa.String(length=50), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['order_id'], ['order.id'], name=op.f('fk_payment_order_id_order')),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('checkout_request_id')
+    )
+    with op.batch_alter_table('payment', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_payment_order_id'), ['order_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('payment', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_payment_order_id'))
+
+    op.drop_table('payment')
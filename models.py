@@ -1,6 +1,8 @@
 from sqlalchemy_serializer import SerializerMixin
+from datetime import datetime
 # from sqlalchemy.ext.associationproxy import association_proxy
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import DDL, event
 from config import db
 
 from flask_bcrypt import Bcrypt
@@ -34,6 +36,11 @@ class Category(db.Model):
         return f'<Category {self.name}>'
 
 class Product(db.Model):
+    __table_args__ = (
+        # Category listings filter on category_id and page by id
+        db.Index('ix_product_category_id_id', 'category_id', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     description = db.Column(db.Text, nullable=False)
@@ -46,29 +53,71 @@ class Product(db.Model):
     def __repr__(self):
         return f'<Product {self.name}, ${self.price}>'
 
+# Full-text index over product names and descriptions (SQLite FTS5).
+# It is an external-content table over product, kept in sync by triggers so every
+# insert, update or delete of a product (from any route) updates the index.
+# Prefix queries up to the longest of PRODUCT_FTS_PREFIXES are served from a
+# prefix index; longer ones would read every match of the prefix.
+PRODUCT_FTS_PREFIXES = (2, 3, 4, 5, 6)
+PRODUCT_FTS_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+    "name, description, content='product', content_rowid='id', "
+    f"tokenize='unicode61 remove_diacritics 2', prefix='{' '.join(map(str, PRODUCT_FTS_PREFIXES))}')",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_ai AFTER INSERT ON product BEGIN "
+    "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_ad AFTER DELETE ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+    "END",
+    "CREATE TRIGGER IF NOT EXISTS product_fts_au AFTER UPDATE OF name, description ON product BEGIN "
+    "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); "
+    "END",
+    "INSERT INTO product_fts(product_fts) VALUES ('rebuild')"
+]
+for statement in PRODUCT_FTS_DDL:
+    event.listen(Product.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(Product.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS product_fts').execute_if(dialect='sqlite'))
+
 class Cart(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True, unique=True)  # one cart per user
+    # Running totals of the cart's items, kept up to date by the cart routes (see carts.py)
+    item_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    subtotal = db.Column(db.Float, nullable=False, default=0, server_default='0')
     items = db.relationship('CartItem', backref='cart', lazy=True)
 
     @property
     def total_price(self):
-        return sum(item.quantity * item.product.price for item in self.items)
+        return round(self.subtotal or 0, 2)
 
     def __repr__(self):
         return f'<Cart {self.id} for User {self.user_id}>'
 
 class CartItem(db.Model):
+    __table_args__ = (
+        # A product appears at most once per cart
+        db.Index('ix_cart_item_cart_id_product_id', 'cart_id', 'product_id', unique=True),
+        # Cart reads and lookups go through the owning user
+        db.Index('ix_cart_item_user_id_product_id', 'user_id', 'product_id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     cart_id = db.Column(db.Integer, db.ForeignKey('cart.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False, default=1)
 
     def __repr__(self):
         return f'<CartItem CartID={self.cart_id} ProductID={self.product_id} Quantity={self.quantity}>'
 
 class Order(db.Model):
+    __table_args__ = (
+        # Order history pages are filtered by user or status and sorted by id
+        db.Index('ix_order_user_id_id', 'user_id', 'id'),
+        db.Index('ix_order_status_id', 'status', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     cart_id = db.Column(db.Integer, db.ForeignKey('cart.id'), nullable=False)
@@ -76,6 +125,7 @@ class Order(db.Model):
     status = db.Column(db.String(50), default='Pending')
     billing_address = db.Column(db.String(255), nullable=True)
     shipping_address = db.Column(db.String(255), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     items = db.relationship('OrderItem', backref='order', lazy=True)
 
     # @property
@@ -87,9 +137,76 @@ class Order(db.Model):
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
 
     def __repr__(self):
-        return f'<OrderItem OrderID={self.order_id} ProductID={self.product_id} Quantity={self.quantity}>'
\ No newline at end of file
+        return f'<OrderItem OrderID={self.order_id} ProductID={self.product_id} Quantity={self.quantity}>'
+
+class Payment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=True, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True, index=True)  # who started the payment
+    phone_number = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='Queued')  # Queued, Sending, Pending, Unknown, Paid or Failed
+    merchant_request_id = db.Column(db.String(100), nullable=True)
+    checkout_request_id = db.Column(db.String(100), nullable=True, unique=True)
+    result_code = db.Column(db.Integer, nullable=True)
+    result_description = db.Column(db.String(255), nullable=True)
+    mpesa_receipt = db.Column(db.String(50), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Payment {self.id} Order={self.order_id} Status={self.status}>'
+
+class Job(db.Model):
+    __table_args__ = (
+        # Workers look for the oldest runnable job in a given status
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)  # registered function, see jobs.py
+    payload = db.Column(db.Text, nullable=False)  # JSON encoded args and kwargs
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done or dead
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime, nullable=True)  # visibility timeout of a running job
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.name} Status={self.status} Attempts={self.attempts}>'
+
+class IdempotencyKey(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('key', 'scope', name='uq_idempotency_key_key_scope'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(255), nullable=False)
+    scope = db.Column(db.String(255), nullable=False)  # method, path and user the key was used for
+    fingerprint = db.Column(db.String(64), nullable=False)  # hash of the request body
+    status_code = db.Column(db.Integer, nullable=True)  # None while the first request is still running
+    response_body = db.Column(db.Text, nullable=True)
+    response_headers = db.Column(db.Text, nullable=True)  # JSON object of the headers sent back on replay
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key} {self.scope} Status={self.status_code}>'
+
+
+class RevokedToken(db.Model):
+    # Refresh tokens that were rotated or logged out, kept until they expire
+    jti = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<RevokedToken {self.jti} User={self.user_id}>'
@@ -0,0 +1,290 @@
+# Standard library imports
+import base64
+import datetime
+import threading
+import time
+
+# Remote library imports
+import requests
+from requests.auth import HTTPBasicAuth
+from sqlalchemy import update
+
+# Local imports
+from config import app, db
+from http_client import CircuitOpenError, outbound, request_not_sent
+from jobs import job
+from models import Order, Payment
+
+
+# Function to build a full Daraja API url from a path
+def mpesa_url(path):
+    return app.config['MPESA_BASE_URL'].rstrip('/') + path
+
+
+# Function to request a new OAuth access token from Safaricom.
+# Returns the token and the number of seconds it is valid for.
+def fetch_access_token():
+    url = mpesa_url('/oauth/v1/generate?grant_type=client_credentials')
+    response = outbound.get(
+        'mpesa.oauth',
+        url,
+        auth=HTTPBasicAuth(app.config['MPESA_CONSUMER_KEY'], app.config['MPESA_CONSUMER_SECRET'])
+    )
+    response.raise_for_status()
+    json_response = response.json()
+    return json_response['access_token'], int(json_response.get('expires_in', 3599))
+
+
+# Keeps the current OAuth access token in memory so payments do not pay for a
+# token request each time. The token is refreshed in the background shortly
+# before it expires; if a refresh fails the old token keeps being used while it
+# is still valid and the refresh is retried.
+class AccessTokenManager:
+
+    def __init__(self, fetch, refresh_margin=60, retry_delay=5):
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.retry_delay = retry_delay
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _is_fresh(self):
+        return self._token is not None and time.monotonic() < self._expires_at - self.refresh_margin
+
+    def _is_valid(self):
+        return self._token is not None and time.monotonic() < self._expires_at
+
+    def get_token(self):
+        if self._is_fresh():
+            return self._token
+
+        with self._lock:
+            # Another thread may have refreshed the token while this one waited
+            if self._is_fresh():
+                return self._token
+            try:
+                self._refresh()
+            except Exception:
+                if self._is_valid():
+                    app.logger.warning('M-Pesa token refresh failed, using the current token', exc_info=True)
+                    return self._token
+                raise
+            return self._token
+
+    def _refresh(self):
+        token, expires_in = self.fetch()
+        self._token = token
+        self._expires_at = time.monotonic() + expires_in
+        self._schedule(expires_in - self.refresh_margin)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(max(delay, 1), self._refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception:
+                app.logger.warning('Background M-Pesa token refresh failed, retrying', exc_info=True)
+                self._schedule(self.retry_delay)
+
+    def reset(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            self._token = None
+            self._expires_at = 0
+
+
+token_manager = AccessTokenManager(
+    fetch_access_token,
+    refresh_margin=app.config['MPESA_TOKEN_REFRESH_MARGIN']
+)
+
+
+# Function to get access token
+def get_access_token():
+    return token_manager.get_token()
+
+
+# Function to generate the password for the STK push request
+def generate_password():
+    timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    password_str = app.config['MPESA_SHORTCODE'] + app.config['MPESA_PASSKEY'] + timestamp
+    password = base64.b64encode(password_str.encode()).decode('utf-8')
+    return password, timestamp
+
+
+# Function to queue the STK push for a payment. The job is committed with the
+# payment row, and a worker sends it so the route can answer straight away.
+def queue_stk_push(payment_id):
+    send_stk_push.delay(payment_id)
+
+
+# Function to mark a payment failed once its STK push job has been dead-lettered
+def fail_stk_push(payment_id):
+    db.session.execute(
+        update(Payment)
+        .where(Payment.id == payment_id)
+        .where(Payment.status == 'Queued')
+        .values(
+            status='Failed',
+            result_description='Could not reach the payment provider',
+            updated_at=datetime.datetime.utcnow()
+        )
+    )
+    db.session.commit()
+
+
+# Job to send the STK push for a queued payment and record the outcome.
+# Errors raised before the request reached Safaricom (no token, connection
+# refused, connect timeout, circuit open) are left to the job queue to retry.
+# Any other transport error may have come after Safaricom received the request
+# and prompted the customer, so the payment is marked Unknown and never sent
+# again; its callback can still settle it (see link_unknown_payment).
+#
+# The payment is committed as Sending before the request goes out. A job that
+# finds its payment still Sending was claimed again after a worker stopped
+# mid-send, so it can not tell whether the push reached Safaricom either and
+# marks the payment Unknown instead of sending it twice.
+@job(max_attempts=5, on_dead=fail_stk_push)
+def send_stk_push(payment_id):
+    payment = db.session.get(Payment, payment_id)
+    if payment and payment.status == 'Sending':
+        payment.status = 'Unknown'
+        payment.result_description = 'The worker stopped while sending the request to the payment provider'
+        db.session.commit()
+        return
+    if not payment or payment.status != 'Queued':
+        return
+
+    access_token = get_access_token()
+    password, timestamp = generate_password()
+
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+
+    payload = {
+        'BusinessShortCode': app.config['MPESA_SHORTCODE'],
+        'Password': password,
+        'Timestamp': timestamp,
+        'TransactionType': 'CustomerPayBillOnline',
+        'Amount': payment.amount,
+        'PartyA': payment.phone_number,
+        'PartyB': app.config['MPESA_SHORTCODE'],
+        'PhoneNumber': payment.phone_number,
+        'CallBackURL': app.config['MPESA_CALLBACK_URL'],
+        'AccountReference': f'Order{payment.order_id}' if payment.order_id else f'Payment{payment.id}',
+        'TransactionDesc': 'Payment for Goods'
+    }
+
+    payment.status = 'Sending'
+    db.session.commit()
+
+    try:
+        response = outbound.post('mpesa.stk_push', mpesa_url('/mpesa/stkpush/v1/processrequest'), json=payload, headers=headers)
+    except (CircuitOpenError, requests.RequestException) as error:
+        if request_not_sent(error):
+            # Nothing reached Safaricom, so the retry may send it
+            payment.status = 'Queued'
+            db.session.commit()
+            raise
+        payment.status = 'Unknown'
+        payment.result_description = f'No response from the payment provider: {error}'[:255]
+        db.session.commit()
+        return
+
+    try:
+        json_response = response.json()
+    except ValueError:
+        # A successful status with an unreadable body may still have prompted the customer
+        payment.status = 'Unknown' if response.ok else 'Failed'
+        payment.result_description = f'Unreadable response from the payment provider ({response.status_code})'
+        db.session.commit()
+        return
+
+    if response.ok and str(json_response.get('ResponseCode')) == '0':
+        # The prompt is on the customer's phone, the callback will settle it
+        payment.status = 'Pending'
+        payment.merchant_request_id = json_response.get('MerchantRequestID')
+        payment.checkout_request_id = json_response.get('CheckoutRequestID')
+    else:
+        payment.status = 'Failed'
+        payment.result_description = str(
+            json_response.get('errorMessage') or json_response.get('ResponseDescription') or response.status_code
+        )[:255]
+    db.session.commit()
+
+
+# Function to link a successful callback to a payment whose STK push got no
+# response, so its CheckoutRequestID was never stored. The callback's phone
+# number and amount pick the oldest matching Unknown payment.
+def link_unknown_payment(checkout_request_id, metadata):
+    if db.session.query(Payment.id).filter_by(checkout_request_id=checkout_request_id).first():
+        return
+    payment_id = db.session.query(Payment.id).filter(
+        Payment.status == 'Unknown',
+        Payment.checkout_request_id.is_(None),
+        Payment.phone_number == str(metadata.get('PhoneNumber')),
+        Payment.amount == metadata.get('Amount')
+    ).order_by(Payment.id).limit(1).scalar()
+    if payment_id is not None:
+        db.session.execute(
+            update(Payment)
+            .where(Payment.id == payment_id)
+            .where(Payment.checkout_request_id.is_(None))
+            .values(checkout_request_id=checkout_request_id)
+        )
+
+
+# Function to apply an STK push result sent to the callback url.
+# Uses conditional UPDATE statements instead of loading rows, so a callback
+# delivered twice (or racing another one) changes each row at most once.
+def apply_stk_callback(callback):
+    checkout_request_id = callback['CheckoutRequestID']
+    result_code = int(callback['ResultCode'])
+    metadata = {
+        item['Name']: item.get('Value')
+        for item in callback.get('CallbackMetadata', {}).get('Item', [])
+    }
+
+    # Failed results carry no metadata to match an Unknown payment with; those
+    # stay Unknown for someone to settle by hand
+    if result_code == 0:
+        link_unknown_payment(checkout_request_id, metadata)
+
+    updated = db.session.execute(
+        update(Payment)
+        .where(Payment.checkout_request_id == checkout_request_id)
+        .where(Payment.status.in_(['Queued', 'Pending', 'Unknown']))
+        .values(
+            status='Paid' if result_code == 0 else 'Failed',
+            result_code=result_code,
+            result_description=str(callback.get('ResultDesc', ''))[:255],
+            mpesa_receipt=metadata.get('MpesaReceiptNumber'),
+            updated_at=datetime.datetime.utcnow()
+        )
+    ).rowcount
+
+    if updated and result_code == 0:
+        paid_order_ids = db.session.query(Payment.order_id).filter(
+            Payment.checkout_request_id == checkout_request_id
+        ).scalar_subquery()
+        db.session.execute(
+            update(Order)
+            .where(Order.id == paid_order_ids)
+            .where(Order.status == 'Pending')
+            .values(status='Paid')
+        )
+
+    db.session.commit()
+    return updated
@@ -0,0 +1,116 @@
+# Standard library imports
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import threading
+
+# Remote library imports
+import bcrypt
+
+# Local imports
+from config import app
+
+
+# Raised when too many password hashes are already waiting for a worker
+class PasswordHasherBusy(Exception):
+    pass
+
+
+# bcrypt only uses the first 72 bytes of a password. Older bcrypt releases
+# (used through Flask-Bcrypt) cut longer passwords silently, newer ones raise,
+# so they are cut here to keep existing hashes valid.
+def _password_bytes(password):
+    return password.encode('utf-8')[:72]
+
+
+# Runs in a worker process
+def _hash_password(password, rounds):
+    return bcrypt.hashpw(_password_bytes(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+# Runs in a worker process
+def _check_password(password_hash, password):
+    try:
+        return bcrypt.checkpw(_password_bytes(password), password_hash.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+
+# Hashes and checks passwords in a pool of worker processes.
+# bcrypt is deliberately slow CPU work; running it in separate processes keeps
+# it from holding the request threads (and the GIL) of the web worker. At most
+# max_pending calls may be running or waiting at once; beyond that
+# PasswordHasherBusy is raised so the route can answer 503 instead of queueing
+# logins without bound. It is also raised when a call takes longer than
+# timeout (its slot stays taken until the worker finishes it) and when a worker
+# process died, in which case the pool is replaced on the next call.
+class PasswordHasher:
+
+    def __init__(self, rounds=12, workers=2, max_pending=16, timeout=30):
+        self.rounds = rounds
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        # Created on first use so forked web workers each start their own pool
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    # A pool whose worker died refuses all further work, so it is dropped
+    def _discard_pool(self, pool):
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy('Too many password checks in progress')
+        pool = self._get_pool()
+        try:
+            future = pool.submit(function, *args)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._discard_pool(pool)
+            raise PasswordHasherBusy('A password worker stopped, restarting the pool')
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # The slot is given back when the worker is done, not when the caller
+        # stops waiting, so timed out calls still count against max_pending
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise PasswordHasherBusy('Password check timed out')
+        except BrokenProcessPool:
+            self._discard_pool(pool)
+            raise PasswordHasherBusy('A password worker stopped, restarting the pool')
+
+    def hash(self, password):
+        return self._run(_hash_password, password, self.rounds)
+
+    def check(self, password_hash, password):
+        return self._run(_check_password, password_hash, password)
+
+    # Whether a stored hash was made with a different cost factor than the configured one
+    def needs_rehash(self, password_hash):
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+
+password_hasher = PasswordHasher(
+    rounds=app.config['BCRYPT_LOG_ROUNDS'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_MAX_PENDING'],
+    timeout=app.config['PASSWORD_HASH_TIMEOUT']
+)
@@ -0,0 +1,194 @@
+# Standard library imports
+import csv
+import io
+import json
+import math
+
+# Remote library imports
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+# Local imports
+from config import app, db
+from models import Category, Product
+
+# Columns written by the export, in CSV column order, and set by the bulk import
+PRODUCT_COLUMNS = ['id', 'name', 'description', 'price', 'image_url', 'category_id']
+IMPORT_COLUMNS = PRODUCT_COLUMNS[1:]
+
+# Rows per multi-row INSERT statement of the bulk import
+ROWS_PER_STATEMENT = 500
+
+
+# Function to tell whether decoded text came from valid UTF-8. Invalid bytes
+# are decoded to lone surrogates (errors='surrogateescape'), which can not be
+# encoded again.
+def _is_utf8(value):
+    try:
+        value.encode('utf-8')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+
+# Function to read product records one at a time from an uploaded stream.
+# Yields (line number, record or None, error or None) without reading the whole
+# body into memory. Lines that are not valid UTF-8 are reported like any other
+# invalid line instead of stopping the import.
+def iter_product_records(stream, data_format):
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='surrogateescape', newline='')
+
+    if data_format == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            # Extra cells are listed under the None key
+            values = []
+            for key, value in record.items():
+                values.append(key)
+                values.extend(value if isinstance(value, list) else [value])
+            if not all(_is_utf8(value) for value in values if isinstance(value, str)):
+                yield reader.line_num, None, 'Invalid UTF-8'
+                continue
+            yield reader.line_num, record, None
+        return
+
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        if not _is_utf8(line):
+            yield line_number, None, 'Invalid UTF-8'
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield line_number, None, 'Invalid JSON'
+            continue
+        if not isinstance(record, dict):
+            yield line_number, None, 'Expected a JSON object'
+            continue
+        yield line_number, record, None
+
+
+# Function to validate a product record. Returns (row, None) with the values to
+# insert in IMPORT_COLUMNS order, or (None, error).
+def validate_product_record(record, category_ids):
+    name = record.get('name')
+    if not isinstance(name, str) or not name.strip() or len(name) > 100:
+        return None, 'name is required and must be at most 100 characters'
+
+    description = record.get('description')
+    if not isinstance(description, str) or not description.strip():
+        return None, 'description is required'
+
+    try:
+        price = float(record.get('price'))
+    except (TypeError, ValueError):
+        return None, 'price must be a number'
+    if not math.isfinite(price):
+        return None, 'price must be a finite number'
+    if price < 0:
+        return None, 'price must not be negative'
+
+    image_url = record.get('image_url') or ''
+    if not isinstance(image_url, str) or len(image_url) > 255:
+        return None, 'image_url must be at most 255 characters'
+
+    try:
+        category_id = int(record.get('category_id'))
+    except (TypeError, ValueError):
+        return None, 'category_id must be an integer'
+    if category_id not in category_ids:
+        return None, f'category {category_id} does not exist'
+
+    return (name, description, price, image_url, category_id), None
+
+
+# Function to insert validated rows with multi-row INSERT statements.
+# Each statement fires the product_fts trigger once for all its rows, which on
+# SQLite is many times faster than the one statement per row executemany sends.
+def insert_product_rows(rows):
+    connection = db.session.connection()
+    placeholder = '?' if connection.dialect.paramstyle == 'qmark' else '%s'
+    row_placeholders = '(' + ', '.join([placeholder] * len(IMPORT_COLUMNS)) + ')'
+    prefix = f"INSERT INTO product ({', '.join(IMPORT_COLUMNS)}) VALUES "
+
+    for start in range(0, len(rows), ROWS_PER_STATEMENT):
+        chunk = rows[start:start + ROWS_PER_STATEMENT]
+        connection.exec_driver_sql(
+            prefix + ', '.join([row_placeholders] * len(chunk)),
+            tuple(value for row in chunk for value in row)
+        )
+
+
+# Function to import products from a stream. Valid rows are inserted and
+# committed batch_size at a time, so a failure part-way keeps the batches
+# already committed. At most max_errors rejected rows are reported. If a batch
+# can not be saved it is rolled back, the import stops, and the result says so
+# under 'failed' with the count of the rows imported before it.
+def import_products(stream, data_format, batch_size=5000, max_errors=100):
+    category_ids = set(db.session.scalars(select(Category.id)))
+    imported = 0
+    rejected = 0
+    errors = []
+    batch = []
+
+    def flush_batch():
+        nonlocal imported
+        try:
+            insert_product_rows(batch)
+            db.session.commit()
+        except SQLAlchemyError:
+            db.session.rollback()
+            raise
+        imported += len(batch)
+        batch.clear()
+
+    try:
+        for line_number, record, error in iter_product_records(stream, data_format):
+            if error is None:
+                row, error = validate_product_record(record, category_ids)
+            if error is not None:
+                rejected += 1
+                if len(errors) < max_errors:
+                    errors.append({'line': line_number, 'error': error})
+                continue
+
+            batch.append(row)
+            if len(batch) >= batch_size:
+                flush_batch()
+
+        if batch:
+            flush_batch()
+    except SQLAlchemyError:
+        app.logger.exception('Product import failed', extra={'imported': imported})
+        return {'imported': imported, 'rejected': rejected, 'errors': errors,
+                'failed': 'Could not save the products, the import stopped'}
+
+    return {'imported': imported, 'rejected': rejected, 'errors': errors}
+
+
+# Function to stream every product as NDJSON or CSV lines. Rows are fetched from
+# the database in chunks of batch_size while the response is being written.
+def export_products(data_format, batch_size=1000):
+    columns = [getattr(Product, column) for column in PRODUCT_COLUMNS]
+    result = db.session.execute(
+        select(*columns).order_by(Product.id).execution_options(yield_per=batch_size)
+    )
+
+    if data_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(PRODUCT_COLUMNS)
+        for partition in result.partitions():
+            writer.writerows(partition)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+        return
+
+    for partition in result.partitions():
+        yield ''.join(
+            json.dumps(dict(zip(PRODUCT_COLUMNS, row))) + '\n' for row in partition
+        )
@@ -0,0 +1,186 @@
+# Standard library imports
+from collections import OrderedDict
+import math
+import sqlite3
+import threading
+import time
+
+# Remote library imports
+from flask import jsonify, request
+from flask_jwt_extended import decode_token
+
+# Local imports
+from config import app
+
+
+# Token buckets kept in this process. Fine for a single worker; with several
+# workers each one enforces the limit separately.
+class MemoryStorage:
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Takes one token from the bucket for key. Returns 0 when allowed, otherwise
+    # the number of seconds until a token is available.
+    def consume(self, key, capacity, rate, now):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, bucket[0] + max(0, now - bucket[1]) * rate)
+                self._buckets.move_to_end(key)
+
+            if tokens >= 1:
+                self._buckets[key] = [tokens - 1, now]
+                # Forget the least recently seen clients once the store is full
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+                return 0
+
+            self._buckets[key] = [tokens, now]
+            return (1 - tokens) / rate
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# Token buckets kept in a small SQLite file, shared by every worker process on
+# the host. It is a separate file from the application database so limiter
+# writes never wait on application transactions.
+class SQLiteStorage:
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS rate_limit_bucket '
+                '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._local.connection = connection
+        return connection
+
+    def consume(self, key, capacity, rate, now):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT tokens, updated_at FROM rate_limit_bucket WHERE key = ?', (key,)
+            ).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(0, now - row[1]) * rate)
+            allowed = tokens >= 1
+            connection.execute(
+                'INSERT OR REPLACE INTO rate_limit_bucket (key, tokens, updated_at) VALUES (?, ?, ?)',
+                (key, tokens - 1 if allowed else tokens, now)
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return 0 if allowed else (1 - tokens) / rate
+
+    def reset(self):
+        self._connection().execute('DELETE FROM rate_limit_bucket')
+
+
+# Function to build the storage named by RATE_LIMIT_STORAGE
+def create_storage(url):
+    if url.startswith('sqlite:///'):
+        return SQLiteStorage(url[len('sqlite:///'):])
+    return MemoryStorage()
+
+
+# Token bucket rate limiter keyed by route and client.
+# limits maps an endpoint name to (requests, seconds): a client may burst up to
+# that many requests and then gets requests / seconds per second back.
+class RateLimiter:
+
+    def __init__(self, storage, limits):
+        self.storage = storage
+        self.limits = {
+            endpoint: (requests_allowed, requests_allowed / seconds)
+            for endpoint, (requests_allowed, seconds) in limits.items()
+        }
+
+    # Returns 0 when the request may go ahead, otherwise the seconds to wait.
+    # Buckets are timed with the wall clock: the SQLite store outlives the
+    # process and reboots, which the monotonic clock does not. The storages
+    # ignore time going backwards, so a clock step can not lock clients out.
+    def hit(self, endpoint, client):
+        limit = self.limits.get(endpoint)
+        if limit is None:
+            return 0
+        capacity, rate = limit
+        return self.storage.consume(f'{endpoint}:{client}', capacity, rate, time.time())
+
+
+# Users of recently seen access tokens. Verifying a token costs far more than
+# the limiter itself, so each token is verified once and its user remembered
+# until the token expires. The view still verifies the token on every request;
+# this is only used to pick the bucket.
+token_users = OrderedDict()
+token_users_lock = threading.Lock()
+
+
+# Function to find the user id a bearer token belongs to, or None
+def token_user(token):
+    with token_users_lock:
+        entry = token_users.get(token)
+    if entry is not None and entry[1] > time.time():
+        return entry[0]
+
+    try:
+        decoded = decode_token(token)
+    except Exception:
+        # Invalid tokens are rejected by the view itself
+        return None
+    identity = decoded.get(app.config.get('JWT_IDENTITY_CLAIM', 'sub'))
+    if not isinstance(identity, dict) or 'id' not in identity:
+        return None
+
+    with token_users_lock:
+        token_users[token] = (identity['id'], decoded.get('exp', float('inf')))
+        while len(token_users) > app.config['RATE_LIMIT_TOKEN_CACHE_SIZE']:
+            token_users.popitem(last=False)
+    return identity['id']
+
+
+# Function to identify the client: the logged-in user when the request carries
+# a valid token, otherwise its IP address
+def client_key():
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        user_id = token_user(authorization[7:])
+        if user_id is not None:
+            return f'user:{user_id}'
+    return f'ip:{request.remote_addr}'
+
+
+limiter = RateLimiter(
+    create_storage(app.config['RATE_LIMIT_STORAGE']),
+    app.config['RATE_LIMITS']
+)
+
+
+# Check the limit of the matched route before its view runs
+@app.before_request
+def apply_rate_limit():
+    if not app.config['RATE_LIMIT_ENABLED'] or request.endpoint not in limiter.limits:
+        return None
+
+    retry_after = limiter.hit(request.endpoint, client_key())
+    if retry_after:
+        return jsonify({'message': 'Too many requests, please slow down'}), 429, {
+            'Retry-After': str(math.ceil(retry_after))
+        }
+    return None
@@ -0,0 +1,140 @@
+# Standard library imports
+import atexit
+import datetime
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+
+# Remote library imports
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+from flask_jwt_extended import get_jwt_identity
+
+# Local imports
+from config import app
+
+# Incoming X-Request-ID values that are reused as the request id
+REQUEST_ID_PATTERN = re.compile(r'^[\w.-]{1,64}$')
+
+# Attributes every LogRecord has; anything else was passed with extra= and is
+# written as a field of its own
+STANDARD_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+# Writes each record as one JSON object per line
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for name, value in vars(record).items():
+            if name not in STANDARD_RECORD_ATTRIBUTES and not name.startswith('_'):
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Adds the id of the current request to records logged while handling it
+class RequestIdFilter(logging.Filter):
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = g.get('request_id') if has_request_context() else None
+        return True
+
+
+# Log records are put on an in-memory queue by the request threads and written
+# to stdout by a background thread, so a slow or blocked stdout never stalls a
+# request. If the queue is full the record is dropped rather than waited for.
+class DroppingQueueHandler(QueueHandler):
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+log_queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+queue_handler = DroppingQueueHandler(log_queue)
+queue_handler.addFilter(RequestIdFilter())
+
+stream_handler = logging.StreamHandler(sys.stdout)
+stream_handler.setFormatter(JsonFormatter())
+log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+root_logger = logging.getLogger()
+root_logger.addHandler(queue_handler)
+root_logger.setLevel(app.config['LOG_LEVEL'])
+app.logger.removeHandler(default_handler)
+
+log_listener.start()
+atexit.register(log_listener.stop)
+
+request_logger = logging.getLogger('requests')
+
+
+@app.before_request
+def start_request_log():
+    incoming = request.headers.get('X-Request-ID', '')
+    g.request_id = incoming if REQUEST_ID_PATTERN.match(incoming) else uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+
+
+# Function to decide whether a finished request is logged. Errors and slow
+# requests always are; with LOG_SLOW_REQUESTS_ONLY nothing else is, otherwise
+# requests to the routes in LOG_SAMPLE_RATES are logged at that rate.
+def should_log_request(status_code, duration_ms):
+    if status_code >= 500 or duration_ms >= app.config['LOG_SLOW_REQUEST_MS']:
+        return True
+    if app.config['LOG_SLOW_REQUESTS_ONLY']:
+        return False
+    rate = app.config['LOG_SAMPLE_RATES'].get(request.endpoint, 1.0)
+    return rate >= 1.0 or random.random() < rate
+
+
+@app.after_request
+def finish_request_log(response):
+    request_id = g.get('request_id')
+    if request_id is None:
+        return response
+    response.headers['X-Request-ID'] = request_id
+
+    duration_ms = round((time.perf_counter() - g.request_started) * 1000, 2)
+    if not should_log_request(response.status_code, duration_ms):
+        return response
+
+    try:
+        identity = get_jwt_identity()
+    except RuntimeError:
+        # The route does not check a token
+        identity = None
+
+    if response.status_code >= 500:
+        level = logging.ERROR
+    elif duration_ms >= app.config['LOG_SLOW_REQUEST_MS']:
+        level = logging.WARNING
+    else:
+        level = logging.INFO
+
+    request_logger.log(level, 'request', extra={
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'duration_ms': duration_ms,
+        'user_id': identity.get('id') if isinstance(identity, dict) else None,
+        'remote_addr': request.remote_addr
+    })
+    return response
@@ -1,6 +1,7 @@
 from config import db, app
 from faker import Faker
 from models import User, Category, Product, Order, Cart, CartItem, OrderItem
+from carts import refresh_cart_totals
 from flask_bcrypt import Bcrypt
 
 # Initialize Bcrypt
@@ -174,17 +175,21 @@ with app.app_context():
     products = Product.query.all()
     for user in customers:
         cart = Cart.query.filter_by(user_id=user.id).first()
-        for _ in range(5):
+        for product in faker.random_elements(elements=products, length=5, unique=True):
             cart_item = CartItem(
                 cart_id=cart.id,
                 user_id=user.id,
-                product_id=faker.random_element(elements=products).id,
+                product_id=product.id,
                 quantity=faker.random_int(min=1, max=3)
             )
             db.session.add(cart_item)
 
     db.session.commit()
 
+    # Store each cart's item count and subtotal
+    refresh_cart_totals([cart.id for cart in Cart.query.all()])
+    db.session.commit()
+
     # Seed orders
     for user in customers:
         for _ in range(3):
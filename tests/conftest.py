@@ -0,0 +1,124 @@
+# Standard library imports
+import os
+import sys
+import tempfile
+
+# The app reads its settings from the environment when it is imported, so the
+# test database and settings are chosen before any app module is loaded
+TEST_DIRECTORY = tempfile.mkdtemp(prefix='allayne-tests-')
+os.environ.update({
+    'APP_ENV': 'test',
+    'DATABASE_URL': 'sqlite:///' + os.path.join(TEST_DIRECTORY, 'test.db'),
+    'IMAGE_STORAGE_DIR': os.path.join(TEST_DIRECTORY, 'images'),
+    'RATE_LIMIT_ENABLED': '0',
+    'BCRYPT_LOG_ROUNDS': '4',
+    'PASSWORD_HASH_WORKERS': '1',
+    'LOG_LEVEL': 'WARNING'
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Remote library imports
+import pytest
+from flask_jwt_extended import create_access_token
+
+# Local imports
+from app import app as flask_app, catalog_cache
+from config import db
+from http_client import outbound
+from models import Cart, Category, Order, Product, User
+from mpesa import token_manager
+from mpesa_stub import StubMpesa
+
+
+@pytest.fixture
+def app():
+    # Identities are {'id', 'role'} dicts, which newer PyJWT versions only
+    # accept as the subject claim when it is not verified
+    flask_app.config.update(TESTING=True, JWT_VERIFY_SUB=False)
+    with flask_app.app_context():
+        db.drop_all()
+        db.create_all()
+    catalog_cache.invalidate()
+    yield flask_app
+    with flask_app.app_context():
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# Function to build the Authorization header of a logged-in user
+def auth_headers(user_id, role='customer'):
+    with flask_app.app_context():
+        token = create_access_token(identity={'id': user_id, 'role': role})
+    return {'Authorization': f'Bearer {token}'}
+
+
+# Creates a user with an empty cart; returns its id and auth headers
+@pytest.fixture
+def make_user(app):
+    def make(username='customer', role='customer'):
+        with app.app_context():
+            user = User(username=username, email=f'{username}@example.com', password='unused', role=role)
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Cart(user_id=user.id))
+            db.session.commit()
+            return user.id, auth_headers(user.id, role)
+    return make
+
+
+# Creates products in one category; returns their ids
+@pytest.fixture
+def make_products(app):
+    def make(count, price=100.0):
+        with app.app_context():
+            category = Category.query.first() or Category(name='Dresses')
+            db.session.add(category)
+            products = [
+                Product(name=f'Dress {number}', description='A dress', price=price, image_url='', category=category)
+                for number in range(count)
+            ]
+            db.session.add_all(products)
+            db.session.commit()
+            return [product.id for product in products]
+    return make
+
+
+# Creates a pending order for a user; returns its id
+@pytest.fixture
+def make_order(app):
+    def make(user_id, total_price=250.0):
+        with app.app_context():
+            cart = Cart.query.filter_by(user_id=user_id).first()
+            order = Order(user_id=user_id, cart_id=cart.id, total_price=total_price)
+            db.session.add(order)
+            db.session.commit()
+            return order.id
+    return make
+
+
+# Points the M-Pesa client at a local stub server for the duration of a test
+@pytest.fixture
+def mpesa(app):
+    stub = StubMpesa()
+    stub.start()
+    settings = {
+        key: app.config[key]
+        for key in ('MPESA_BASE_URL', 'MPESA_CALLBACK_TOKEN', 'JOB_RETRY_BACKOFF')
+    }
+    app.config.update(MPESA_BASE_URL=stub.url, MPESA_CALLBACK_TOKEN='callback-secret', JOB_RETRY_BACKOFF=0)
+    backoff = outbound.backoff
+    outbound.backoff = 0
+    outbound._breakers.clear()
+    token_manager.reset()
+
+    yield stub
+
+    token_manager.reset()
+    outbound.backoff = backoff
+    outbound._breakers.clear()
+    app.config.update(settings)
+    stub.stop()
@@ -0,0 +1,76 @@
+# Standard library imports
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+
+# Local stand-in for the Safaricom Daraja API, served from a thread.
+# It records the requests it gets; tests change how it answers through
+# token_status, expires_in and stk_mode ('accept', 'reject' or 'drop', which
+# reads the STK push and closes the connection without answering).
+class StubMpesa:
+
+    def __init__(self):
+        self.token_requests = 0
+        self.token_status = 200
+        self.expires_in = 3599
+        self.stk_requests = []
+        self.stk_mode = 'accept'
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if not self.path.startswith('/oauth/v1/generate'):
+                    return self.send_json(404, {})
+                with stub._lock:
+                    stub.token_requests += 1
+                    number = stub.token_requests
+                if stub.token_status != 200:
+                    return self.send_json(stub.token_status, {'errorMessage': 'Unavailable'})
+                self.send_json(200, {'access_token': f'token-{number}', 'expires_in': str(stub.expires_in)})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with stub._lock:
+                    stub.stk_requests.append({'body': body, 'authorization': self.headers.get('Authorization')})
+                    number = len(stub.stk_requests)
+
+                if stub.stk_mode == 'drop':
+                    self.close_connection = True
+                    self.connection.close()
+                elif stub.stk_mode == 'reject':
+                    self.send_json(400, {'errorCode': '400.002.02', 'errorMessage': 'Bad Request - Invalid PhoneNumber'})
+                else:
+                    self.send_json(200, {
+                        'MerchantRequestID': f'merchant-{number}',
+                        'CheckoutRequestID': f'ws_CO_{number}',
+                        'ResponseCode': '0',
+                        'ResponseDescription': 'Success. Request accepted for processing',
+                        'CustomerMessage': 'Success. Request accepted for processing'
+                    })
+
+        return Handler
@@ -0,0 +1,58 @@
+# Remote library imports
+import pytest
+from sqlalchemy import event
+
+# Local imports
+from config import db
+from models import Cart, CartItem
+
+
+# Counts the SQL statements run while the block is active
+class QueryCounter:
+
+    def __init__(self, app):
+        self.app = app
+        self.statements = []
+
+    def __enter__(self):
+        with self.app.app_context():
+            self.engine = db.engine
+        event.listen(self.engine, 'before_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self.record)
+
+    def record(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+def fill_cart(app, user_id, product_ids):
+    with app.app_context():
+        cart = Cart.query.filter_by(user_id=user_id).first()
+        for quantity, product_id in enumerate(product_ids, start=1):
+            db.session.add(CartItem(cart_id=cart.id, user_id=user_id, product_id=product_id, quantity=quantity))
+        db.session.commit()
+
+
+@pytest.mark.parametrize('item_count', [1, 20])
+def test_get_cart_runs_two_queries_whatever_its_size(app, client, make_user, make_products, item_count):
+    user_id, headers = make_user()
+    fill_cart(app, user_id, make_products(item_count, price=150.0))
+
+    with QueryCounter(app) as counter:
+        response = client.get('/cart', headers=headers)
+
+    assert response.status_code == 200
+    assert len(response.json['items']) == item_count
+    assert len(counter.statements) == 2, counter.statements
+
+
+def test_get_cart_total_is_price_times_quantity(app, client, make_user, make_products):
+    user_id, headers = make_user()
+    fill_cart(app, user_id, make_products(3, price=99.99))
+
+    response = client.get('/cart', headers=headers)
+
+    # Quantities are 1, 2 and 3
+    assert response.json['total_price'] == round(99.99 * 6, 2)
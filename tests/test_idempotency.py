@@ -0,0 +1,88 @@
+# Standard library imports
+from datetime import datetime, timedelta
+import hashlib
+
+# Local imports
+from config import db
+from models import IdempotencyKey, Order, Payment
+from test_cart import fill_cart
+from test_mpesa_payments import PHONE_NUMBER
+
+
+def with_key(headers, key='key-1'):
+    return {**headers, 'Idempotency-Key': key}
+
+
+def test_retry_with_the_same_key_replays_the_first_response(app, client, make_user, make_products):
+    user_id, headers = make_user()
+    fill_cart(app, user_id, make_products(1))
+
+    first = client.post('/orders', json={}, headers=with_key(headers))
+    retry = client.post('/orders', json={}, headers=with_key(headers))
+
+    assert first.status_code == retry.status_code == 201
+    assert retry.json == first.json
+    assert retry.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+    with app.app_context():
+        assert Order.query.count() == 1
+
+
+def test_replay_keeps_the_location_header(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    body = {'order_id': make_order(user_id), 'phone_number': PHONE_NUMBER}
+
+    first = client.post('/mpesa/stk_push', json=body, headers=with_key(headers))
+    retry = client.post('/mpesa/stk_push', json=body, headers=with_key(headers))
+
+    assert first.status_code == retry.status_code == 202
+    assert retry.headers['Location'] == first.headers['Location'] == f"/mpesa/payments/{first.json['payment_id']}"
+    assert retry.headers['Content-Type'] == 'application/json'
+    with app.app_context():
+        assert Payment.query.count() == 1
+
+
+def test_key_reused_with_a_different_body_is_refused(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+
+    client.post('/mpesa/stk_push', json={'order_id': order_id, 'phone_number': PHONE_NUMBER}, headers=with_key(headers))
+    response = client.post('/mpesa/stk_push', json={'order_id': order_id, 'phone_number': '254700000000'},
+                           headers=with_key(headers))
+
+    assert response.status_code == 422
+    with app.app_context():
+        assert Payment.query.count() == 1
+
+
+def test_key_still_in_flight_is_refused(app, client, make_user, make_products):
+    user_id, headers = make_user()
+    fill_cart(app, user_id, make_products(1))
+    # The first request with this key and body reserved it and has not finished
+    with app.app_context():
+        db.session.add(IdempotencyKey(
+            key='key-1', scope=f'POST /orders {user_id}',
+            fingerprint=hashlib.sha256(b'{}').hexdigest(),
+            expires_at=datetime.utcnow() + timedelta(hours=1)
+        ))
+        db.session.commit()
+
+    response = client.post('/orders', data=b'{}', headers=with_key(headers), content_type='application/json')
+
+    assert response.status_code == 409
+    with app.app_context():
+        assert Order.query.count() == 0
+
+
+def test_keys_are_scoped_to_the_user(app, client, make_user, make_products):
+    user_id, headers = make_user('first')
+    other_id, other_headers = make_user('second')
+    product_ids = make_products(1)
+    fill_cart(app, user_id, product_ids)
+    fill_cart(app, other_id, product_ids)
+
+    first = client.post('/orders', json={}, headers=with_key(headers))
+    other = client.post('/orders', json={}, headers=with_key(other_headers))
+
+    assert first.status_code == other.status_code == 201
+    assert first.json['order_id'] != other.json['order_id']
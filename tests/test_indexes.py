@@ -0,0 +1,117 @@
+# Standard library imports
+import re
+
+# Remote library imports
+import pytest
+from sqlalchemy import event
+
+# Local imports
+from config import db
+from models import OrderItem
+from test_cart import fill_cart
+
+
+# Hot routes, the indexes their queries should be answered from, and the index
+# a paginated listing must also take its order from (other results are a
+# handful of rows and may be sorted after the lookup). URLs and bodies are
+# built from the shop fixture.
+HOT_ROUTES = {
+    'GET /cart': (
+        'get', lambda shop: '/cart', 'customer', None,
+        ['ix_cart_user_id', 'ix_cart_item_user_id_product_id'], None
+    ),
+    'POST /cart': (
+        'post', lambda shop: '/cart', 'customer', lambda shop: {'product_id': shop['new_product_id'], 'quantity': 1},
+        ['ix_cart_user_id'], None
+    ),
+    'GET /orders': (
+        'get', lambda shop: '/orders?status=Pending', 'admin', None,
+        ['ix_order_status_id', 'ix_order_item_order_id'], 'ix_order_status_id'
+    ),
+    'GET /orders/my-orders': (
+        'get', lambda shop: '/orders/my-orders', 'customer', None,
+        ['ix_order_user_id_id', 'ix_order_item_order_id'], 'ix_order_user_id_id'
+    ),
+    'GET /api/categories/<id>/products': (
+        'get', lambda shop: f"/api/categories/{shop['category_id']}/products", None, None,
+        ['ix_product_category_id_id'], 'ix_product_category_id_id'
+    ),
+    'DELETE /products/<id>': (
+        'delete', lambda shop: f"/products/{shop['carted_product_id']}", 'admin', None,
+        ['ix_order_item_product_id', 'ix_cart_item_product_id'], None
+    )
+}
+
+
+# A customer with two products in their cart and a pending order for a third
+@pytest.fixture
+def shop(app, make_user, make_products, make_order):
+    user_id, customer_headers = make_user()
+    _, admin_headers = make_user('admin', role='admin')
+    ordered_product_id, carted_product_id, other_product_id, new_product_id = make_products(4)
+    fill_cart(app, user_id, [carted_product_id, other_product_id])
+    order_id = make_order(user_id)
+    with app.app_context():
+        db.session.add(OrderItem(order_id=order_id, product_id=ordered_product_id, quantity=1))
+        db.session.commit()
+    return {
+        'headers': {'customer': customer_headers, 'admin': admin_headers, None: {}},
+        'category_id': 1,
+        'carted_product_id': carted_product_id,
+        'new_product_id': new_product_id
+    }
+
+
+# Function to make a request and return the (statement, parameters) pairs it ran
+def captured_statements(app, client, method, url, headers, body):
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = getattr(client, method)(url, headers=headers, json=body)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code < 300, response.get_data(as_text=True)
+    return statements
+
+
+# Function to get the EXPLAIN QUERY PLAN lines of a statement as it was run
+def query_plan(statement, parameters):
+    connection = db.session.connection()
+    return [row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', parameters)]
+
+
+@pytest.mark.parametrize('name', HOT_ROUTES)
+def test_hot_route_queries_use_their_indexes(app, client, shop, name):
+    method, url, role, body, index_names, ordered_by = HOT_ROUTES[name]
+    statements = captured_statements(
+        app, client, method, url(shop), shop['headers'][role], body(shop) if body else None
+    )
+
+    with app.app_context():
+        table_names = set(db.metadata.tables)
+        plans = [
+            (statement, query_plan(statement, parameters))
+            for statement, parameters in statements
+            if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE'))
+        ]
+    assert plans
+
+    lines = [line for _, plan in plans for line in plan]
+    for index_name in index_names:
+        assert any(index_name in line for line in lines), (index_name, plans)
+    # No statement reads a whole table
+    for statement, plan in plans:
+        for line in plan:
+            scanned = re.match(r'SCAN (\w+)', line)
+            assert not (scanned and scanned.group(1) in table_names and 'USING' not in line), (statement, plan)
+    if ordered_by is not None:
+        for statement, plan in plans:
+            if any(ordered_by in line for line in plan):
+                assert not any('TEMP B-TREE' in line for line in plan), (statement, plan)
@@ -0,0 +1,52 @@
+# Local imports
+from config import db
+import jobs
+from models import Job
+
+runs = []
+
+
+def fail_loudly(name):
+    raise RuntimeError(f'on_dead for {name} failed too')
+
+
+@jobs.job(max_attempts=1, on_dead=fail_loudly)
+def always_fails(name):
+    raise ValueError(name)
+
+
+@jobs.job()
+def record_run(name):
+    runs.append(name)
+
+
+def test_worker_survives_a_failing_dead_letter_handler(app):
+    runs.clear()
+    with app.app_context():
+        always_fails.delay('first')
+        record_run.delay('second')
+        db.session.commit()
+
+    # The on_dead error is logged instead of stopping the worker
+    jobs.run_worker(once=True)
+    jobs.run_worker(once=True)
+
+    assert runs == ['second']
+    with app.app_context():
+        assert sorted(job.status for job in Job.query.all()) == ['dead', 'done']
+
+
+def test_failed_job_is_retried_until_dead(app):
+    app.config['JOB_RETRY_BACKOFF'], backoff = 0, app.config['JOB_RETRY_BACKOFF']
+    try:
+        with app.app_context():
+            jobs.enqueue('tests.unknown_job', max_attempts=2)
+            db.session.commit()
+        jobs.run_worker(once=True)
+    finally:
+        app.config['JOB_RETRY_BACKOFF'] = backoff
+
+    with app.app_context():
+        job = Job.query.one()
+        assert (job.status, job.attempts) == ('dead', 2)
+        assert 'No job function registered' in job.last_error
@@ -0,0 +1,220 @@
+# Standard library imports
+from datetime import datetime, timedelta
+
+# Remote library imports
+import pytest
+
+# Local imports
+from config import db
+import jobs
+from models import Job, Order, Payment
+import mpesa as mpesa_module
+from mpesa import get_access_token
+
+PHONE_NUMBER = '254708374149'
+
+
+# Function to build the body Safaricom posts to the callback url
+def stk_callback(checkout_request_id, result_code=0, amount=250.0, receipt='QKH7Y2ZQ1P'):
+    callback = {
+        'MerchantRequestID': 'merchant-1',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Request cancelled by user'
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': amount},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+            {'Name': 'TransactionDate', 'Value': 20261018120000},
+            {'Name': 'PhoneNumber', 'Value': int(PHONE_NUMBER)}
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+# Function to start a payment for an order and run the queued STK push
+def pay_order(client, headers, order_id):
+    response = client.post('/mpesa/stk_push', json={'order_id': order_id, 'phone_number': PHONE_NUMBER}, headers=headers)
+    assert response.status_code == 202
+    assert response.json['status'] == 'Queued'
+    jobs.run_worker(once=True)
+    return response.json['payment_id']
+
+
+def post_callback(client, body):
+    return client.post('/mpesa/callback?token=callback-secret', json=body)
+
+
+def payment_status(client, headers, payment_id):
+    response = client.get(f'/mpesa/payments/{payment_id}', headers=headers)
+    assert response.status_code == 200
+    return response.json
+
+
+def order_status(app, order_id):
+    with app.app_context():
+        return db.session.get(Order, order_id).status
+
+
+def test_push_then_callback_marks_payment_and_order_paid(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+
+    payment_id = pay_order(client, headers, order_id)
+    assert payment_status(client, headers, payment_id)['status'] == 'Pending'
+    assert len(mpesa.stk_requests) == 1
+    sent = mpesa.stk_requests[0]['body']
+    assert sent['Amount'] == 250.0
+    assert sent['PhoneNumber'] == PHONE_NUMBER
+    assert sent['AccountReference'] == f'Order{order_id}'
+
+    response = post_callback(client, stk_callback('ws_CO_1'))
+    assert response.status_code == 200
+    assert response.json['ResultCode'] == 0
+
+    status = payment_status(client, headers, payment_id)
+    assert status['status'] == 'Paid'
+    assert status['mpesa_receipt'] == 'QKH7Y2ZQ1P'
+    assert order_status(app, order_id) == 'Paid'
+
+
+def test_duplicate_callback_changes_nothing(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+    payment_id = pay_order(client, headers, order_id)
+
+    assert post_callback(client, stk_callback('ws_CO_1')).status_code == 200
+    # A late failure report for the same request must not undo the payment
+    assert post_callback(client, stk_callback('ws_CO_1', result_code=1032)).status_code == 200
+    assert post_callback(client, stk_callback('ws_CO_1', receipt='OTHER')).status_code == 200
+
+    status = payment_status(client, headers, payment_id)
+    assert status['status'] == 'Paid'
+    assert status['mpesa_receipt'] == 'QKH7Y2ZQ1P'
+    assert order_status(app, order_id) == 'Paid'
+
+
+def test_failed_callback_leaves_order_pending(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+    payment_id = pay_order(client, headers, order_id)
+
+    assert post_callback(client, stk_callback('ws_CO_1', result_code=1032)).status_code == 200
+
+    assert payment_status(client, headers, payment_id)['status'] == 'Failed'
+    assert order_status(app, order_id) == 'Pending'
+
+
+def test_rejected_push_fails_the_payment(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    mpesa.stk_mode = 'reject'
+    payment_id = pay_order(client, headers, make_order(user_id))
+
+    status = payment_status(client, headers, payment_id)
+    assert status['status'] == 'Failed'
+    assert 'Invalid PhoneNumber' in status['result_description']
+    assert len(mpesa.stk_requests) == 1
+
+
+def test_connection_dropped_after_push_is_never_resent(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+    mpesa.stk_mode = 'drop'
+
+    payment_id = pay_order(client, headers, order_id)
+    jobs.run_worker(once=True)
+
+    # Safaricom may have prompted the customer, so the push is not sent again
+    assert len(mpesa.stk_requests) == 1
+    assert payment_status(client, headers, payment_id)['status'] == 'Unknown'
+    with app.app_context():
+        assert [job.status for job in Job.query.all()] == ['done']
+
+    # The callback still settles it, matched on phone number and amount
+    assert post_callback(client, stk_callback('ws_CO_77')).status_code == 200
+    assert payment_status(client, headers, payment_id)['status'] == 'Paid'
+    assert order_status(app, order_id) == 'Paid'
+
+
+def test_push_from_a_worker_that_died_is_never_resent(app, client, mpesa, make_user, make_order, monkeypatch):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+    post = mpesa_module.outbound.post
+
+    # The worker process is killed right after the request went out
+    def post_then_die(*args, **kwargs):
+        post(*args, **kwargs)
+        raise SystemExit()
+
+    monkeypatch.setattr(mpesa_module.outbound, 'post', post_then_die)
+    response = client.post('/mpesa/stk_push', json={'order_id': order_id, 'phone_number': PHONE_NUMBER}, headers=headers)
+    payment_id = response.json['payment_id']
+    with pytest.raises(SystemExit):
+        jobs.run_worker(once=True)
+    monkeypatch.setattr(mpesa_module.outbound, 'post', post)
+    assert payment_status(client, headers, payment_id)['status'] == 'Sending'
+
+    # Another worker claims the job once its visibility timeout has passed
+    with app.app_context():
+        Job.query.one().locked_until = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+    jobs.run_worker(once=True)
+
+    assert len(mpesa.stk_requests) == 1
+    assert payment_status(client, headers, payment_id)['status'] == 'Unknown'
+    assert post_callback(client, stk_callback('ws_CO_1')).status_code == 200
+    assert payment_status(client, headers, payment_id)['status'] == 'Paid'
+
+
+def test_unreachable_provider_is_retried_then_failed(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+    with app.app_context():
+        get_access_token()
+    # Nothing listens on the stub's port once it is stopped, so the push
+    # never connects and can safely be tried again
+    mpesa.stop()
+
+    payment_id = pay_order(client, headers, order_id)
+
+    with app.app_context():
+        job = Job.query.one()
+        assert job.status == 'dead'
+        assert job.attempts == job.max_attempts
+        assert 'ConnectionError' in job.last_error
+    status = payment_status(client, headers, payment_id)
+    assert status['status'] == 'Failed'
+    assert order_status(app, order_id) == 'Pending'
+
+
+def test_callback_requires_the_token(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    order_id = make_order(user_id)
+    payment_id = pay_order(client, headers, order_id)
+
+    assert client.post('/mpesa/callback', json=stk_callback('ws_CO_1')).status_code == 403
+    assert client.post('/mpesa/callback?token=wrong', json=stk_callback('ws_CO_1')).status_code == 403
+    assert payment_status(client, headers, payment_id)['status'] == 'Pending'
+
+    # Outside development, callbacks are refused while no token is configured
+    app.config['MPESA_CALLBACK_TOKEN'] = None
+    assert post_callback(client, stk_callback('ws_CO_1')).status_code == 403
+    assert payment_status(client, headers, payment_id)['status'] == 'Pending'
+
+
+def test_payment_is_only_visible_to_its_owner(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user('buyer')
+    _, other_headers = make_user('other')
+    admin_id, admin_headers = make_user('admin', role='admin')
+    order_id = make_order(user_id)
+    payment_id = pay_order(client, headers, order_id)
+
+    assert client.get(f'/mpesa/payments/{payment_id}').status_code == 401
+    assert client.get(f'/mpesa/payments/{payment_id}', headers=other_headers).status_code == 404
+    assert client.get(f'/mpesa/payments/{payment_id}', headers=admin_headers).status_code == 200
+
+    # Nor can another user start a payment for the order
+    response = client.post('/mpesa/stk_push', json={'order_id': order_id, 'phone_number': PHONE_NUMBER}, headers=other_headers)
+    assert response.status_code == 404
+    with app.app_context():
+        assert Payment.query.count() == 1
@@ -0,0 +1,75 @@
+# Standard library imports
+import time
+
+# Remote library imports
+import pytest
+import requests
+
+# Local imports
+import jobs
+from mpesa import AccessTokenManager, fetch_access_token, get_access_token, token_manager
+
+
+def test_token_is_fetched_once_and_reused(app, mpesa):
+    with app.app_context():
+        tokens = [get_access_token() for _ in range(3)]
+
+    assert tokens == ['token-1'] * 3
+    assert mpesa.token_requests == 1
+
+
+def test_token_is_refreshed_within_the_refresh_margin(app, mpesa):
+    with app.app_context():
+        assert get_access_token() == 'token-1'
+        # The token now expires sooner than the refresh margin
+        token_manager._expires_at = time.monotonic() + token_manager.refresh_margin / 2
+        assert get_access_token() == 'token-2'
+        assert get_access_token() == 'token-2'
+
+    assert mpesa.token_requests == 2
+
+
+def test_failed_refresh_keeps_the_valid_token(app, mpesa):
+    with app.app_context():
+        assert get_access_token() == 'token-1'
+        token_manager._expires_at = time.monotonic() + token_manager.refresh_margin / 2
+        mpesa.token_status = 500
+        assert get_access_token() == 'token-1'
+
+    assert mpesa.token_requests == 2
+
+
+def test_failed_refresh_of_an_expired_token_raises(app, mpesa):
+    with app.app_context():
+        assert get_access_token() == 'token-1'
+        token_manager._expires_at = time.monotonic() - 1
+        mpesa.token_status = 500
+        with pytest.raises(requests.HTTPError):
+            get_access_token()
+
+
+def test_token_is_refreshed_in_the_background(app, mpesa):
+    mpesa.expires_in = 2
+    manager = AccessTokenManager(fetch_access_token, refresh_margin=1)
+    try:
+        assert manager.get_token() == 'token-1'
+        deadline = time.monotonic() + 5
+        while mpesa.token_requests < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert mpesa.token_requests == 2
+        assert manager.get_token() == 'token-2'
+    finally:
+        manager.reset()
+
+
+def test_stk_pushes_share_one_token(app, client, mpesa, make_user, make_order):
+    user_id, headers = make_user()
+    for _ in range(3):
+        order_id = make_order(user_id)
+        response = client.post('/mpesa/stk_push', json={'order_id': order_id, 'phone_number': '254708374149'}, headers=headers)
+        assert response.status_code == 202
+    jobs.run_worker(once=True)
+
+    assert len(mpesa.stk_requests) == 3
+    assert {request['authorization'] for request in mpesa.stk_requests} == {'Bearer token-1'}
+    assert mpesa.token_requests == 1
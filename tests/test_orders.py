@@ -0,0 +1,73 @@
+# Standard library imports
+import threading
+
+# Remote library imports
+from sqlalchemy import event
+
+# Local imports
+from config import db
+from models import Cart, CartItem, Order, OrderItem
+from test_cart import fill_cart
+
+
+def test_checkout_prices_the_order_from_the_database(app, client, make_user, make_products):
+    user_id, headers = make_user()
+    product_ids = make_products(2, price=150.0)
+    fill_cart(app, user_id, product_ids)
+
+    # Prices and totals sent by the client are ignored
+    response = client.post('/orders', json={'total_price': 1, 'items': [{'product_id': product_ids[0], 'price': 1}]},
+                           headers=headers)
+
+    assert response.status_code == 201
+    # fill_cart puts one of the first product and two of the second in the cart
+    assert response.json['total_price'] == 450.0
+    with app.app_context():
+        order = db.session.get(Order, response.json['order_id'])
+        assert order.total_price == 450.0
+        assert sorted((item.product_id, item.quantity) for item in order.items) == [(product_ids[0], 1), (product_ids[1], 2)]
+        assert CartItem.query.count() == 0
+        cart = Cart.query.filter_by(user_id=user_id).first()
+        assert (cart.item_count, cart.subtotal) == (0, 0)
+
+
+def test_checkout_of_an_empty_cart_is_refused(client, make_user):
+    _, headers = make_user()
+
+    response = client.post('/orders', json={}, headers=headers)
+
+    assert response.status_code == 404
+
+
+def test_concurrent_checkouts_of_one_cart_create_one_order(app, make_user, make_products):
+    user_id, headers = make_user()
+    fill_cart(app, user_id, make_products(3))
+
+    # Both requests read the cart before either of them writes anything
+    both_read = threading.Barrier(2)
+
+    def wait_for_the_other_checkout(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().startswith('SELECT cart_item.id') and 'JOIN product' in statement:
+            both_read.wait(timeout=5)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'after_cursor_execute', wait_for_the_other_checkout)
+    responses = []
+
+    def checkout():
+        responses.append(app.test_client().post('/orders', json={}, headers=headers))
+
+    threads = [threading.Thread(target=checkout) for _ in range(2)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=30)
+    finally:
+        event.remove(engine, 'after_cursor_execute', wait_for_the_other_checkout)
+
+    assert sorted(response.status_code for response in responses) == [201, 409]
+    with app.app_context():
+        assert Order.query.count() == 1
+        assert OrderItem.query.count() == 3
@@ -0,0 +1,86 @@
+# Standard library imports
+import os
+import signal
+import time
+
+# Remote library imports
+import pytest
+
+# Local imports
+from config import db
+from models import User
+from passwords import PasswordHasher, PasswordHasherBusy, password_hasher
+
+
+@pytest.fixture
+def hasher():
+    hasher = PasswordHasher(rounds=4, workers=1, max_pending=1, timeout=30)
+    yield hasher
+    if hasher._pool is not None:
+        hasher._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def test_hash_and_check(hasher):
+    password_hash = hasher.hash('secret')
+
+    assert hasher.check(password_hash, 'secret')
+    assert not hasher.check(password_hash, 'wrong')
+    assert not hasher.check('not a bcrypt hash', 'secret')
+
+
+# Function to kill the worker processes of a hasher's pool and wait until the
+# pool has noticed
+def kill_workers(hasher):
+    pool = hasher._get_pool()
+    pool.submit(int).result()
+    for process in list(pool._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+    deadline = time.monotonic() + 10
+    while not pool._broken and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return pool
+
+
+def test_a_dead_worker_is_replaced(hasher):
+    password_hash = hasher.hash('secret')
+    pool = kill_workers(hasher)
+
+    with pytest.raises(PasswordHasherBusy):
+        hasher.check(password_hash, 'secret')
+    assert hasher.check(password_hash, 'secret')
+    assert hasher._pool is not pool
+
+
+def test_a_timed_out_call_keeps_its_slot_until_the_worker_is_done(hasher):
+    hasher.rounds = 14
+    hasher.timeout = 0.01
+    # Warm the pool up so the timeout only covers hashing
+    hasher._get_pool().submit(int).result()
+
+    with pytest.raises(PasswordHasherBusy, match='timed out'):
+        hasher.hash('secret')
+    with pytest.raises(PasswordHasherBusy, match='in progress'):
+        hasher.hash('secret')
+
+    hasher.rounds = 4
+    hasher.timeout = 30
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            password_hash = hasher.hash('secret')
+            break
+        except PasswordHasherBusy:
+            time.sleep(0.05)
+    assert hasher.check(password_hash, 'secret')
+
+
+def test_login_answers_503_once_when_a_worker_dies(app, client):
+    with app.app_context():
+        db.session.add(User(username='customer', email='customer@example.com',
+                            password=password_hasher.hash('secret'), role='customer'))
+        db.session.commit()
+    kill_workers(password_hasher)
+
+    credentials = {'username': 'customer', 'password': 'secret'}
+    assert client.post('/login', json=credentials).status_code == 503
+    assert client.post('/login', json=credentials).status_code == 200
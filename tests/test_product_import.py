@@ -0,0 +1,94 @@
+# Standard library imports
+import json
+
+# Remote library imports
+from sqlalchemy.exc import OperationalError
+
+# Local imports
+from config import db
+from models import Product
+import product_io
+
+
+def ndjson(*records):
+    return ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+
+
+def product(category_id, name='Maxi Dress', price=1500):
+    return {'name': name, 'description': 'A dress', 'price': price, 'image_url': '', 'category_id': category_id}
+
+
+def product_count(app):
+    with app.app_context():
+        return Product.query.count()
+
+
+def test_import_rejects_prices_that_are_not_finite(app, client, make_user, make_products):
+    _, headers = make_user('admin', role='admin')
+    make_products(1)
+
+    body = ndjson(product(1, price='nan'), product(1, price='inf'), product(1))
+    response = client.post('/products/bulk', data=body, headers=headers, content_type='application/x-ndjson')
+
+    assert response.status_code == 200
+    assert response.json['imported'] == 1
+    assert response.json['errors'] == [
+        {'line': 1, 'error': 'price must be a finite number'},
+        {'line': 2, 'error': 'price must be a finite number'}
+    ]
+
+
+def test_import_reports_invalid_utf8_per_line(app, client, make_user, make_products):
+    _, headers = make_user('admin', role='admin')
+    make_products(1)
+
+    body = ndjson(product(1, name='First')) + b'{"name": "\xff\xfe"}\n' + ndjson(product(1, name='Third'))
+    response = client.post('/products/bulk', data=body, headers=headers, content_type='application/x-ndjson')
+
+    assert response.status_code == 200
+    assert response.json['imported'] == 2
+    assert response.json['errors'] == [{'line': 2, 'error': 'Invalid UTF-8'}]
+
+
+def test_import_reports_invalid_utf8_in_csv(app, client, make_user, make_products):
+    _, headers = make_user('admin', role='admin')
+    make_products(1)
+
+    body = (b'name,description,price,image_url,category_id\n'
+            b'First,A dress,100,,1\n'
+            b'Sec\xffond,A dress,100,,1\n')
+    response = client.post('/products/bulk?format=csv', data=body, headers=headers)
+
+    assert response.json['imported'] == 1
+    assert response.json['errors'] == [{'line': 3, 'error': 'Invalid UTF-8'}]
+
+
+def test_a_failed_batch_keeps_the_batches_before_it(app, client, make_user, make_products, monkeypatch):
+    _, headers = make_user('admin', role='admin')
+    make_products(1)
+    app.config['PRODUCT_IMPORT_BATCH_SIZE'], batch_size = 2, app.config['PRODUCT_IMPORT_BATCH_SIZE']
+
+    insert_product_rows = product_io.insert_product_rows
+    calls = []
+
+    def fail_second_batch(rows):
+        calls.append(rows)
+        if len(calls) == 2:
+            raise OperationalError('INSERT', (), Exception('database is locked'))
+        insert_product_rows(rows)
+
+    monkeypatch.setattr(product_io, 'insert_product_rows', fail_second_batch)
+    # Cache the listing so the test can tell the import invalidated it
+    client.get('/products')
+
+    try:
+        body = ndjson(*[product(1, name=f'Imported {number}') for number in range(5)])
+        response = client.post('/products/bulk', data=body, headers=headers, content_type='application/x-ndjson')
+    finally:
+        app.config['PRODUCT_IMPORT_BATCH_SIZE'] = batch_size
+
+    assert response.status_code == 500
+    assert response.json['imported'] == 2
+    assert 'failed' in response.json
+    assert product_count(app) == 3
+    assert len(client.get('/products').json) == 3
@@ -0,0 +1,99 @@
+# Local imports
+from config import db
+from models import Category, Product
+
+
+# Creates products from (name, description, category name) tuples; returns their ids
+def add_products(app, *products):
+    with app.app_context():
+        categories = {}
+        rows = []
+        for name, description, category_name in products:
+            if category_name not in categories:
+                categories[category_name] = Category(name=category_name)
+            rows.append(Product(name=name, description=description, price=100.0, image_url='',
+                                category=categories[category_name]))
+        db.session.add_all(rows)
+        db.session.commit()
+        return [row.id for row in rows]
+
+
+def names(response):
+    return [product['name'] for product in response.json]
+
+
+def test_name_matches_come_before_description_matches(app, client):
+    add_products(
+        app,
+        ('Maxi Dress', 'Floral print', 'Dresses'),
+        ('Linen Shirt', 'Goes with any dress', 'Tops'),
+        ('Floral Dress', 'Summer cut', 'Dresses'),
+    )
+
+    response = client.get('/products/search?q=dress')
+
+    assert response.status_code == 200
+    # Newest first among the name matches, then the description matches
+    assert names(response) == ['Floral Dress', 'Maxi Dress', 'Linen Shirt']
+
+
+def test_every_word_matches_as_a_prefix(app, client):
+    add_products(
+        app,
+        ('Floral Dress', 'Summer cut', 'Dresses'),
+        ('Floral Top', 'Summer cut', 'Tops'),
+        ('Sweatshirt', 'Cotton', 'Tops'),
+    )
+
+    assert names(client.get('/products/search?q=dre+flo')) == ['Floral Dress']
+    # Words longer than the prefix index are cut to its longest prefix
+    assert names(client.get('/products/search?q=sweatshi')) == ['Sweatshirt']
+
+
+def test_search_filters_by_category(app, client):
+    add_products(
+        app,
+        ('Floral Dress', 'Summer cut', 'Dresses'),
+        ('Floral Top', 'Summer cut', 'Tops'),
+    )
+    with app.app_context():
+        tops = Category.query.filter_by(name='Tops').one()
+
+    response = client.get(f'/products/search?q=floral&category_id={tops.id}')
+
+    assert names(response) == ['Floral Top']
+
+
+def test_search_pages_with_offset(app, client):
+    add_products(app, *[(f'Dress {number}', 'A dress', 'Dresses') for number in range(5)])
+
+    first = client.get('/products/search?q=dress&limit=2')
+    last = client.get('/products/search?q=dress&limit=2&offset=4')
+
+    assert names(first) == ['Dress 4', 'Dress 3']
+    assert first.headers['X-Next-Cursor'] == '2'
+    assert names(last) == ['Dress 0']
+    assert 'X-Next-Cursor' not in last.headers
+
+
+def test_search_refuses_offsets_past_the_result_limit(app, client):
+    app.config['SEARCH_MAX_RESULTS'], max_results = 3, app.config['SEARCH_MAX_RESULTS']
+    try:
+        response = client.get('/products/search?q=dress&offset=3')
+    finally:
+        app.config['SEARCH_MAX_RESULTS'] = max_results
+
+    assert response.status_code == 400
+
+
+def test_search_requires_a_query(client):
+    assert client.get('/products/search?q=').status_code == 400
+
+
+def test_search_answers_501_without_sqlite(app, client, monkeypatch):
+    with app.app_context():
+        monkeypatch.setattr(db.engine.dialect, 'name', 'postgresql')
+
+    response = client.get('/products/search?q=dress')
+
+    assert response.status_code == 501